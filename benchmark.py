@@ -0,0 +1,277 @@
+import os, sys, json, time, math, random, argparse, tempfile, platform, datetime, weakref
+
+# the benchmarks never open a window or play sound
+os.environ['SDL_VIDEODRIVER'] = 'dummy'
+os.environ['SDL_AUDIODRIVER'] = 'dummy'
+
+import pygame
+import game
+
+MAPS = ['game_map.json', 'map_created.json', 'map_v2.json', 'map.json'] # maps shipped with the game
+MONSTER_COUNTS = [1, 100, 1000, 10000] # monsters on the generated maps
+RESULTS_FILE = 'benchmark_results.json' # results of the last run
+BASELINE_FILE = 'benchmark_baseline.json' # results the run is compared against
+TOLERANCE = 0.25 # slowdown against the baseline reported as a regression
+GROUND_GID = 1 # walkable tile of the generated maps
+ROCK_GID = 2 # blocking tile of the generated maps
+ROCK_CHANCE = 0.05 # share of the generated map covered by rocks
+SAMPLE_TIME = 0.05 # shortest time in seconds of one timed batch of calls
+
+def time_call(func, repeat=5, number=None):
+    ''' returns the best and mean milliseconds of one call of func. Unless
+        given, the calls per batch grow until a batch takes SAMPLE_TIME '''
+
+    if number == None:
+        number = 1
+        while True:
+            start = time.perf_counter()
+            for j in range(number):
+                func()
+            if time.perf_counter() - start >= SAMPLE_TIME:
+                break
+            number *= 2
+
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        for j in range(number):
+            func()
+        times.append((time.perf_counter() - start) * 1000 / number)
+
+    return {"best_ms": min(times), "mean_ms": sum(times) / len(times)}
+
+def blank_table(anim):
+    ''' returns a frame table with the layout of an animation whose
+        images are missing, so the game logic can still be timed '''
+
+    frame = pygame.Surface((64, 64))
+    frame.set_colorkey(tuple(anim.get("colorkey", (0, 0, 0))))
+    return tuple(tuple(frame for col in range(anim["cols"])) for row in range(anim["rows"]))
+
+def characters():
+    ''' returns the animations of every character, from their definitions '''
+
+    spec = json.loads(open(game.ANIMATION_FILE).read())["characters"]
+    return dict((name, [action["animation"] for action in character["actions"]]) for name, character in spec.items())
+
+def load_bank(results):
+    ''' returns an animation bank holding every character animation '''
+
+    bank = game.Animation_Bank()
+    for names in characters().values():
+        for name in names:
+            try:
+                bank.load(name)
+            except (OSError, pygame.error) as error:
+                results["animations/%s/blank" % name] = {"reason": str(error)}
+                bank.animations[name] = blank_table(bank.spec[name])
+                bank.users[name] = weakref.WeakSet()
+    return bank
+
+def bench_create_map(results):
+    ''' times compiling each shipped map and loading it from its cache '''
+
+    for map_file in MAPS:
+        results["create_map/%s/compile" % map_file] = time_call(lambda: game.compile_map(map_file))
+
+        # the first call writes the cache when it is missing or stale
+        game.create_map(map_file)
+        results["create_map/%s/cached" % map_file] = time_call(lambda: game.create_map(map_file))
+
+def bench_sprite_frames(results):
+    ''' times loading and ordering the frames of each character '''
+
+    spec = json.loads(open(game.ANIMATION_FILE).read())["animations"]
+    for character, names in characters().items():
+        for name in names:
+            anim = spec[name]
+            if "sheet" in anim:
+                load = lambda: game.slice_sheet(anim)
+            else:
+                load = lambda: game.create_sprite_frames(anim["directory"], anim["prefix"], tuple(anim["colorkey"]))
+
+            try:
+                results["sprite_frames/%s/%s" % (character, name)] = time_call(load, repeat=3)
+            except (OSError, pygame.error) as error:
+                results["sprite_frames/%s/%s" % (character, name)] = {"skipped": str(error)}
+
+def bench_entity(results, bank):
+    ''' times the per-entity calls of a tick on the player and a monster '''
+
+    # the per-entity functions run on Monster sprites
+    world = game.World(MAPS[0], bank, entity_store=False)
+    player = world.player
+    monster = world.spawn_monster(player.pos_x + 100, player.pos_y + 100)
+
+    for name, obj, others in [("player", player, world.monster_sprite_list),
+                              ("monster", monster, world.active_sprite_list)]:
+
+        # head somewhere far away so every call has work to do
+        obj.target_pos = (obj.pos_x + 10000, obj.pos_y + 10000)
+        results["entity/%s/set_direction" % name] = time_call(lambda: game.set_direction(obj))
+        results["entity/%s/check_collision" % name] = time_call(
+            lambda: game.check_collision(obj, world.collision_grid, others, world.spatial_hash))
+        results["entity/%s/set_frame" % name] = time_call(lambda: game.set_frame(obj))
+
+def generate_map(directory, monsters):
+    ''' writes a square map with scattered rocks and the monsters spawned
+        across it, larger for more monsters, and returns its file '''
+
+    side = max(50, int(8 * math.sqrt(monsters)))
+    rng = random.Random(monsters)
+
+    ground = [GROUND_GID] * (side * side)
+    rocks = [ROCK_GID if rng.random() < ROCK_CHANCE else 0 for cell in range(side * side)]
+
+    # the player starts in the middle, the monsters anywhere
+    spawns = [{"name": "char_spawn", "x": side * 16, "y": side * 16}]
+    for index in range(monsters):
+        spawns.append({"name": "monster_spawn_%d" % index,
+                       "x": rng.randint(0, side * 32 - 64), "y": rng.randint(0, side * 32 - 64)})
+
+    mapdict = { "type": "map", "width": side, "height": side, "tilewidth": 32, "tileheight": 32,
+                "tilesets": [{"firstgid": 1, "source": "landscape_5.json"}],
+                "layers": [ {"name": "ground", "width": side, "height": side, "data": ground},
+                            {"name": "rocks", "width": side, "height": side, "data": rocks,
+                             "properties": {"collision": True}},
+                            {"name": "spawn_objects", "objects": spawns} ] }
+
+    map_file = os.path.join(directory, "generated_%d.json" % monsters)
+    with open(map_file, 'w') as file:
+        json.dump(mapdict, file)
+    return map_file
+
+def time_tick(results, name, world):
+    ''' times the update and the draw of one tick of the world '''
+
+    screen = pygame.Surface((game.SCREENWIDTH, game.SCREENHEIGHT))
+    camera = game.Camera(game.SCREENWIDTH, game.SCREENHEIGHT)
+    count = len(world.monster_sprite_list)
+
+    def update():
+        world.step([])
+        camera.follow(world.player)
+
+    def draw():
+        screen.fill((0, 0, 0))
+        world.draw(screen, camera)
+
+    # bake the chunks around the player before timing
+    update()
+    draw()
+
+    update_time = time_call(update, repeat=3)
+    results[name + "/update"] = update_time
+    results[name + "/draw"] = time_call(draw, repeat=3)
+    results[name + "/update_per_monster"] = {"best_ms": update_time["best_ms"] / max(count, 1),
+                                             "mean_ms": update_time["mean_ms"] / max(count, 1)}
+
+def bench_ticks(results, bank, counts):
+    ''' times a full game tick, update and draw, with more and more
+        monsters, with the monsters as sprites and in the entity store '''
+
+    with tempfile.TemporaryDirectory() as directory:
+        for count in counts:
+            map_file = generate_map(directory, count)
+
+            random.seed(0)
+            time_tick(results, "tick/%d" % count, game.World(map_file, bank, entity_store=False))
+
+            if game.numpy != None:
+                random.seed(0)
+                time_tick(results, "tick_store/%d" % count, game.World(map_file, bank, entity_store=True))
+
+def bench_replays(results, bank, replay_files):
+    ''' times recorded games, replayed tick for tick, so slow sessions
+        from the field can be measured against the baseline '''
+
+    for replay_file in replay_files:
+        replay = game.Input_Replay(replay_file)
+        name = os.path.splitext(os.path.basename(replay_file))[0]
+
+        mean_ticks, worst_ticks = [], []
+        for i in range(3):
+            world, times = replay.run(bank)
+            mean_ticks.append(sum(times) * 1000 / max(len(times), 1))
+            worst_ticks.append(max(times, default=0) * 1000)
+            if replay.checksum != bytes(20) and world.checksum() != replay.checksum:
+                results["replay/%s/diverged" % name] = {"reason": "the replay ended differently from the recording"}
+
+        results["replay/%s/tick" % name] = {"best_ms": min(mean_ticks), "mean_ms": sum(mean_ticks) / len(mean_ticks)}
+        results["replay/%s/worst_tick" % name] = {"best_ms": min(worst_ticks), "mean_ms": sum(worst_ticks) / len(worst_ticks)}
+
+def compare(results, baseline, tolerance):
+    ''' prints every timing against the baseline and returns the names of
+        those which are slower than the tolerance allows '''
+
+    regressions = []
+    for name, result in sorted(results.items()):
+        if "best_ms" not in result:
+            print("%-55s %s" % (name, result.get("skipped") or result.get("reason")))
+            continue
+
+        line = "%-55s %10.4f ms" % (name, result["best_ms"])
+        base = baseline.get(name)
+        if base and base.get("best_ms"):
+            ratio = result["best_ms"] / base["best_ms"]
+            line += "  %10.4f ms  x%.2f" % (base["best_ms"], ratio)
+            if ratio > 1 + tolerance:
+                line += "  REGRESSION"
+                regressions.append(name)
+        print(line)
+
+    return regressions
+
+def main():
+
+    parser = argparse.ArgumentParser(description='times the hot paths of the game offline')
+    parser.add_argument('--output', default=RESULTS_FILE, help='file the results are written to')
+    parser.add_argument('--baseline', default=BASELINE_FILE, help='results to compare against')
+    parser.add_argument('--save-baseline', action='store_true', help='store these results as the baseline')
+    parser.add_argument('--counts', type=int, nargs='+', default=MONSTER_COUNTS, help='monsters per tick benchmark')
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE, help='slowdown reported as a regression')
+    parser.add_argument('--replays', nargs='+', default=[], help='recorded games to time, see game.py --record')
+    args = parser.parse_args()
+
+    # recordings are given relative to where the benchmarks were started
+    replays = [os.path.abspath(replay_file) for replay_file in args.replays]
+
+    # the game loads its assets relative to its own folder
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    # a display is needed to convert images, the dummy one shows nothing
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+
+    results = {}
+    bench_create_map(results)
+    bench_sprite_frames(results)
+    bank = load_bank(results)
+    bench_entity(results, bank)
+    bench_ticks(results, bank, args.counts)
+    bench_replays(results, bank, replays)
+
+    report = {  "created": datetime.datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "pygame": pygame.version.ver,
+                "platform": platform.platform(),
+                "benchmarks": results  }
+    with open(args.output, 'w') as file:
+        json.dump(report, file, indent=1)
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        baseline = json.loads(open(args.baseline).read())["benchmarks"]
+    regressions = compare(results, baseline, args.tolerance)
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump(report, file, indent=1)
+        print("saved the baseline to %s" % args.baseline)
+
+    if regressions:
+        print("%d benchmarks are slower than the baseline" % len(regressions))
+        sys.exit(1)
+
+if __name__ == '__main__':
+        main()
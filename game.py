@@ -1,19 +1,62 @@
-import pygame, sys, math, random, json, datetime, os
+import pygame, sys, math, random, json, datetime, os, weakref, bisect, time
+import mmap, struct, array, hashlib, threading, queue, argparse, heapq, collections
 from pygame.locals import *
 
-FPS = 20 # frames per second setting
+FPS = 60 # most frames drawn per second
+TICK_RATE = 20 # game logic ticks per second, every speed and timer is counted in ticks
+MAX_FRAME_SKIP = 5 # ticks run without drawing when behind, after that the game slows down
 SCREENWIDTH = 1000
 SCREENHEIGHT = 500
-
-UP = 'up'
-DOWN = 'down'
-LEFT = 'left'
-RIGHT = 'right'
-UP_RIGHT = 'up-right'
-UP_LEFT = 'up-left'
-DOWN_RIGHT = 'down-right'
-DOWN_LEFT = 'down-left'
-STOP = 'stop'
+CHUNK_SIZE = 16 # tiles along each side of a pre-rendered map chunk
+SPATIAL_HASH_CELL = 64 # size in pixels of a cell holding nearby game objects
+AGGRO_RADIUS = 200 # monsters closer than this to the player go looking for them
+FLOW_FIELD_RADIUS = 16 # cells around the player's cell the monsters' flow field reaches
+FLOW_FIELD_MARGIN = 8 # pixels kept clear around an agent, it turns this near a cell's corner
+PATH_CLUSTER_SIZE = 16 # cells along each side of a cluster of the path graph
+PATH_CLEARANCE = 1 # cells on every side of a path cell which must be free, so a monster fits
+PATH_ENTRANCE_SPLIT = 6 # entrances between clusters this wide get a portal at each end
+PATH_CACHE_SIZE = 256 # routes between clusters kept by the path graph
+WANDER_DISTANCE = 320 # farthest in pixels along each axis a monster wanders to
+AI_NEAR_RADIUS = 600 # monsters this close to the player think every tick
+AI_MID_RADIUS = 1200 # monsters this close think every AI_MID_INTERVAL ticks, the rest hibernate
+AI_MID_INTERVAL = 4 # ticks between the thinking of monsters at mid range
+AI_FAR_INTERVAL = 16 # ticks between the moves of hibernating monsters
+AI_TIME_BUDGET = 0.004 # seconds of a tick monsters away from the player may take, None for no limit
+ANIMATION_FILE = 'animations.json' # layout of every animation in the game
+ATLAS_FILE = 'atlas.json' # manifest of the packed animation atlas, see pack_atlas.py
+MAP_CACHE_EXTENSION = '.mapc' # compiled maps are saved next to their JSON
+MAP_CACHE_MAGIC = b'PGMC'
+MAP_CACHE_VERSION = 3
+REPLAY_MAGIC = b'PGRP'
+REPLAY_VERSION = 1
+STREAM_RADIUS = 2 # chunks around the player's chunk kept baked and prefetched
+STREAM_MEMORY_BUDGET = 64 * 1024 * 1024 # bytes of baked chunks kept before distant ones are evicted
+STREAM_BUILDS_PER_FRAME = 4 # prefetched chunks turned into surfaces each frame
+PROFILE_FRAMES = 120 # frames kept by the profiler
+PROFILE_FILE = 'frame_trace.json' # chrome trace written by the profiler
+DIRTY_RENDERING = True # redraw only the parts of the screen which changed
+DIRTY_AREA_LIMIT = 0.5 # share of the screen changed above which everything is redrawn
+ENTITY_STORE = None # keep the monsters in numpy arrays when numpy is installed, None decides by ENTITY_STORE_THRESHOLD
+ENTITY_STORE_THRESHOLD = 5000 # monster spawn points from which the numpy arrays tick faster than sprites
+RANGE_ATTACK_POOL = 256 # range attacks which can be in flight at once
+RANGE_ATTACK_LIFETIME = 60 # ticks a range attack flies before it fizzles out
+FIRE_SPELL_SPEED = 20 # pixels a fire spell flies each tick
+ASSET_WORKERS = 4 # threads reading and decoding asset files
+ASSET_FINISH_TIME = 0.01 # seconds of a frame the main thread spends converting loaded assets
+MUSIC_FILE = 'mozart.wav' # background music, streamed from disk
+SOUND_CHANNELS = 8 # mixer channels the sound effects share
+TEXT_CACHE_SIZE = 128 # rendered text surfaces kept, the least recently used is dropped first
+
+# directions are indexes into the frame arrays of every action
+UP = 0
+DOWN = 1
+LEFT = 2
+RIGHT = 3
+UP_RIGHT = 4
+UP_LEFT = 5
+DOWN_RIGHT = 6
+DOWN_LEFT = 7
+STOP = 8
 
 
 MOVE = 'move'
@@ -25,10 +68,36 @@ COLLIDE = 'collide'
 # holds all spells in the game 
 RANGE_ATTACK_DIC = {}
 
+# the inputs a replay can hold, by their code in the file
+REPLAY_ACTIONS = (MOVE, ATTACK, SPELL)
+
+# the file and priority of every sound effect, higher priorities take channels from lower ones
+SOUND_EFFECTS = {           'attack':('beep.wav', 1), 'hit':('beep.wav', 2),
+                            'spell':('beep.wav', 3), 'spell_hit':('beep.wav', 2)     }
+
 # opposite direction dictionary
 OPPOSITE_DIRECTION = {      UP:DOWN, DOWN:UP, LEFT:RIGHT, RIGHT:LEFT,
                             UP_RIGHT:DOWN_LEFT, UP_LEFT:DOWN_RIGHT,
                             DOWN_LEFT:UP_RIGHT, DOWN_RIGHT: UP_LEFT     }
+
+# the x and y step of one pixel moved in each direction
+DIRECTION_VECTOR = {        UP:(0,-1), DOWN:(0,1), LEFT:(-1,0), RIGHT:(1,0),
+                            UP_RIGHT:(1,-1), UP_LEFT:(-1,-1),
+                            DOWN_LEFT:(-1,1), DOWN_RIGHT:(1,1), STOP:(0,0)     }
+
+# the direction of each x and y step
+VECTOR_DIRECTION = dict((vector, direction) for direction, vector in DIRECTION_VECTOR.items())
+
+# every direction a character can face, in index order
+DIRECTIONS = (UP, DOWN, LEFT, RIGHT, UP_RIGHT, UP_LEFT, DOWN_RIGHT, DOWN_LEFT)
+
+# the direction of each name used in ANIMATION_FILE
+DIRECTION_NAMES = {         'up':UP, 'down':DOWN, 'left':LEFT, 'right':RIGHT,
+                            'up-right':UP_RIGHT, 'up-left':UP_LEFT,
+                            'down-left':DOWN_LEFT, 'down-right':DOWN_RIGHT     }
+
+# the direction shown by animations without diagonal rows
+DIRECTION_FALLBACK = {      UP_RIGHT:RIGHT, UP_LEFT:LEFT, DOWN_RIGHT:RIGHT, DOWN_LEFT:LEFT     }
                       
 
 #        R    G    B
@@ -52,6 +121,12 @@ try:
 except ImportError:
     android = None
 
+# thousands of monsters are kept in numpy arrays if it is installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
 class Item(pygame.sprite.Sprite):
     ''' class for all items in the game '''
 
@@ -65,35 +140,22 @@ class Item(pygame.sprite.Sprite):
         # setup a rect reference for each tile
         self.rect = self.image.get_rect()
 
-class Range_Attack(pygame.sprite.Sprite):
-    ''' contains sprities for each range attack '''
-
-    def __init__(self, speed):
-
-        pygame.sprite.Sprite.__init__(self)
+class Range_Attack():
+    ''' one range attack in flight, a record of a Range_Attack_Pool.
+        It has the sprite attributes the game needs and no frames of its
+        own, those are shared through the definition of its spell '''
 
-        # This holds all the sprite images for each direction
-        self.move_frames_ul = []
-        self.move_frames_ur = []
-        self.move_frames_dl = []
-        self.move_frames_dr = []
-        self.move_frames_l = []
-        self.move_frames_d = []
-        self.move_frames_r = []
-        self.move_frames_u = []
+    __slots__ = ['pool', 'index', 'definition', 'direction', 'collide', 'frame', 'speed',
+                 'timer_for_attack', 'ticks', 'target_pos', 'image', 'anchor', 'rect', 'live']
 
-        self.collide_frames = []
+    def __init__(self, pool, index):
 
-        
-        self.move_tup = (   self.move_frames_l,
-                            self.move_frames_ul,
-                            self.move_frames_u,
-                            self.move_frames_ur,
-                            self.move_frames_r,
-                            self.move_frames_dr,
-                            self.move_frames_d,
-                            self.move_frames_dl )
+        # the pool holding the record and its place in it
+        self.pool = pool
+        self.index = index
 
+        # the definition of the spell, its frames by action and direction
+        self.definition = None
 
         # each range attack has a direction from when it was casted
         self.direction = None
@@ -102,58 +164,1673 @@ class Range_Attack(pygame.sprite.Sprite):
         self.collide = False
 
         # starting frame
-        self.frame = 0        
-        self.speed = speed
+        self.frame = 0
+        self.speed = 0
 
-        # image
+        # range attacks have no cooldown
+        self.timer_for_attack = 0
+
+        # ticks since the attack was cast
+        self.ticks = 0
+
+        # check_collision stops whatever collides
+        self.target_pos = (None, None)
+
+        # image, its rect is moved along with the attack so it has no anchor
         self.image = None
+        self.anchor = None
+        self.rect = pygame.Rect(0, 0, 0, 0)
+
+        self.live = False
 
-    def cast_attack(self, range_sprite_lst, char):
-        ''' allows the initialization of a range attack '''
+    def cast_attack(self, definition, char, speed):
+        ''' starts the range attack from the character, facing the same way '''
+
+        self.definition = definition
+        self.direction = char.direction
+        self.collide = False
+        self.frame = 0
+        self.speed = speed
+        self.ticks = 0
+        self.live = True
 
         # set initalized frame and create attack rect
-        self.set_range_direction(char)
         set_frame(self)
         create_range_attack_rect(self, char)
 
-        # create the spell
-        range_sprite_lst.add(self)
+    def alive(self):
+        return self.live
 
-    def set_range_direction(self, char):
-        ''' sets the direction of the spell to be the same as the player '''
+    def kill(self):
+        ''' gives the record back to the pool '''
 
-        self.direction = char.direction
+        if self.live:
+            self.live = False
+            self.pool.free.append(self.index)
 
-class Tile(pygame.sprite.Sprite):
-    def __init__(self, image):
-        ''' class containing the blit information
-            of a layered map based on JSON data '''
+class Range_Attack_Pool():
+    ''' every range attack record, made once when the world is created.
+        Casting takes a free record and hitting something or flying for
+        RANGE_ATTACK_LIFETIME ticks gives it back, so casts allocate
+        nothing. The live records are kept in cast order and iterate like
+        a sprite group '''
 
-        # set player set, Sprite class super reference, and the image of the
-        # Tile
-        pygame.sprite.Sprite.__init__(self)
+    def __init__(self, capacity=RANGE_ATTACK_POOL, lifetime=RANGE_ATTACK_LIFETIME, previous=None):
 
-        # tile image
-        self.image = image
+        self.records = [Range_Attack(self, index) for index in range(capacity)]
+        self.lifetime = lifetime
 
-        # same as the default player speed
-        self.speed = 5
+        # the world's interpolation snapshot, a reused record must not be drawn from where it last flew
+        if previous == None:
+            previous = {}
+        self.previous = previous
 
-        # setup a rect reference for each tile
-        self.rect = self.image.get_rect()
-    
-    def setup_player_spawn(self, adjust_x, adjust_y):
-        ''' based on the [0, 0] at the top-left
-            setup map position based on char_spawn '''
-        self.rect.x -= adjust_x
-        self.rect.y -= adjust_y
-             
-    def update(self, player):
-        ''' move the map in the opposite direction of player movement
-            This is also used to test collisions '''
-        
-        if player.target_pos != (None, None):
-            move_object(self, OPPOSITE_DIRECTION[player.direction])
+        # free records, the lowest index is taken first
+        self.free = list(range(capacity - 1, -1, -1))
+
+        # records in flight, in the order they were cast
+        self.live = []
+
+    def cast(self, definition, char, speed):
+        ''' starts a range attack of the spell from the character and
+            returns it, or None when every record is in flight '''
+
+        if len(self.free) == 0:
+            return None
+
+        range_attack = self.records[self.free.pop()]
+        self.previous.pop(range_attack, None)
+        range_attack.cast_attack(definition, char, speed)
+        self.live.append(range_attack)
+        return range_attack
+
+    def step(self, collision_grid, targets, spatial_hash):
+        ''' animates and moves every range attack in flight, and drops
+            those which finished or flew too long. Returns how many hit
+            something this tick '''
+
+        live = self.live
+        kept = 0
+        hits = 0
+        for range_attack in live:
+            set_frame(range_attack)
+
+            # once an attack hits something it stays put until its collide frames end
+            if range_attack.live and not range_attack.collide:
+                check_collision(range_attack, collision_grid, targets, spatial_hash)
+                if range_attack.collide:
+                    hits += 1
+                else:
+                    move_object(range_attack, range_attack.direction)
+                    range_attack.ticks += 1
+                    if range_attack.ticks >= self.lifetime:
+                        range_attack.kill()
+
+            # keep the live records at the front, in order
+            if range_attack.live:
+                live[kept] = range_attack
+                kept += 1
+        del live[kept:]
+
+        return hits
+
+    def sprites(self):
+        return list(self.live)
+
+    def __iter__(self):
+        return iter(self.live)
+
+    def __len__(self):
+        return len(self.live)
+
+    def __contains__(self, range_attack):
+        return type(range_attack) == Range_Attack and range_attack.live
+
+class Tileset():
+    ''' one tileset of a map. Its image is only loaded, and its tiles only
+        cut out as subsurfaces, once a gid of the tileset is used '''
+
+    def __init__(self, tileset):
+
+        # tilesets are resolved by compile_map, so they are all embedded
+        self.firstgid = tileset["firstgid"]
+
+        self.image_source = tileset["image"]
+        self.tilewidth = tileset["tilewidth"]
+        self.tileheight = tileset["tileheight"]
+        self.margin = tileset.get("margin", 0)
+        self.spacing = tileset.get("spacing", 0)
+
+        # number of tiles in a row of the image
+        self.columns = tileset.get("columns")
+        if self.columns == None:
+            self.columns = (tileset["imagewidth"] - 2 * self.margin + self.spacing) // (self.tilewidth + self.spacing)
+
+        # the whole tileset image, and the tiles cut out of it keyed by gid
+        self.image = None
+        self.tiles = {}
+
+    def preload(self, loader, group):
+        ''' decodes the tileset image on the loader's threads, so drawing
+            the first chunks doesn't wait for it '''
+
+        loader.request(self.image_source, group, pygame.image.load, (self.image_source,), self.set_image)
+
+    def set_image(self, image):
+        ''' converts a decoded tileset image, on the main thread '''
+
+        if self.image == None:
+            self.image = image.convert_alpha()
+
+    def get_tile(self, gid):
+        ''' returns the image of the tile, sharing the pixels of the tileset '''
+
+        tile = self.tiles.get(gid)
+
+        if tile == None:
+            if self.image == None:
+                self.image = pygame.image.load(self.image_source).convert_alpha()
+
+            tile_id = gid - self.firstgid
+            tilex = self.margin + (tile_id % self.columns) * (self.tilewidth + self.spacing)
+            tiley = self.margin + (tile_id // self.columns) * (self.tileheight + self.spacing)
+            tile = self.image.subsurface((tilex, tiley, self.tilewidth, self.tileheight))
+            self.tiles[gid] = tile
+
+        return tile
+
+class Chunked_Layer():
+    ''' a tile layer drawn as CHUNK_SIZE x CHUNK_SIZE tile surfaces, so
+        drawing the layer is a few blits per frame instead of one blit
+        per tile. A chunk is baked the first time it is seen '''
+
+    def __init__(self, data, width, height, tilewidth, tileheight, tilesets, above=False):
+
+        # gids of the layer row by row, and the tilesets ordered by firstgid
+        self.data = data
+        self.tilesets = tilesets
+        self.firstgids = [tileset.firstgid for tileset in tilesets]
+
+        # size of the layer in tiles
+        self.width = width
+        self.height = height
+
+        # size of a tile and of a whole chunk in pixels
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+        self.chunk_width = CHUNK_SIZE * tilewidth
+        self.chunk_height = CHUNK_SIZE * tileheight
+
+        # pre-rendered chunk surfaces, keyed by (chunk column, chunk row)
+        # chunks without a single tile are stored as None
+        self.chunks = {}
+
+        # the tiles in each baked chunk, for the profiler
+        self.tile_counts = {}
+
+        # the area of the whole layer in the world, the map starts at [0,0]
+        self.rect = pygame.Rect(0, 0, width * tilewidth, height * tileheight)
+
+        # layers above the characters, like tree tops, are drawn over them
+        self.render_layer = Render_Queue.ABOVE if above else Render_Queue.GROUND
+
+    def get_tile(self, gid):
+        ''' returns the image of a tile from the tileset holding the gid '''
+
+        # the tileset holding the gid has the last firstgid not above it
+        tileset = self.tilesets[bisect.bisect_right(self.firstgids, gid) - 1]
+        return tileset.get_tile(gid)
+
+    def plan_chunk(self, col, row):
+        ''' returns the gid of every tile of a chunk with the left and
+            bottom of its cell in the chunk. It only reads the gids, so
+            it can run on a background thread '''
+
+        first_x, first_y = col * CHUNK_SIZE, row * CHUNK_SIZE
+        chunk_cols = min(CHUNK_SIZE, self.width - first_x)
+        chunk_rows = min(CHUNK_SIZE, self.height - first_y)
+
+        plan = []
+        for y in range(chunk_rows):
+            row_start = (first_y + y) * self.width + first_x
+            bottom = (y + 1) * self.tileheight
+            x = 0
+            for gid in self.data[row_start:row_start + chunk_cols]:
+                if gid > 0:
+                    plan.append((gid, x * self.tilewidth, bottom))
+                x += 1
+
+        return plan
+
+    def build_chunk(self, col, row, plan):
+        ''' blits the planned tiles of a chunk onto one surface, on the
+            main thread. Like Tiled, tiles of a different size sit on the
+            bottom-left of their cell '''
+
+        self.tile_counts[(col, row)] = len(plan)
+
+        # nothing to draw in this chunk
+        if not plan:
+            self.chunks[(col, row)] = None
+            return
+
+        blit_lst = []
+        for gid, x, bottom in plan:
+            image = self.get_tile(gid)
+            blit_lst.append((image, (x, bottom - image.get_height())))
+
+        chunk = pygame.Surface((min(CHUNK_SIZE, self.width - col * CHUNK_SIZE) * self.tilewidth,
+                                min(CHUNK_SIZE, self.height - row * CHUNK_SIZE) * self.tileheight)).convert()
+        chunk.fill(BLACK)
+        chunk.set_colorkey(BLACK)
+        chunk.blits(blit_lst, False)
+        self.chunks[(col, row)] = chunk
+
+    def bake_chunk(self, col, row):
+        ''' plans and builds a chunk right away '''
+
+        self.build_chunk(col, row, self.plan_chunk(col, row))
+
+    def submit(self, queue, camera):
+        ''' submits only the chunks which can be seen by the camera to the
+            render queue, and returns how many chunks and how many tiles
+            in them were submitted '''
+
+        view = camera.rect
+        drawn = 0
+        tiles = 0
+
+        # range of chunks that can be seen
+        first_col = max(0, (view.left - self.rect.x) // self.chunk_width)
+        last_col = min((self.width - 1) // CHUNK_SIZE, (view.right - 1 - self.rect.x) // self.chunk_width)
+        first_row = max(0, (view.top - self.rect.y) // self.chunk_height)
+        last_row = min((self.height - 1) // CHUNK_SIZE, (view.bottom - 1 - self.rect.y) // self.chunk_height)
+
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                if (col, row) not in self.chunks:
+                    self.bake_chunk(col, row)
+                chunk = self.chunks[(col, row)]
+                if chunk != None:
+                    queue.submit(chunk, (self.rect.x + col * self.chunk_width - view.x,
+                                         self.rect.y + row * self.chunk_height - view.y), self.render_layer)
+                    drawn += 1
+                    tiles += self.tile_counts[(col, row)]
+
+        return drawn, tiles
+
+class Chunk_Streamer():
+    ''' keeps only the chunks near the player baked. Chunks within radius
+        of the player's chunk are planned ahead of time on a background
+        thread and built into surfaces a few per frame on the main thread,
+        and chunks outside it are evicted, least recently used first,
+        whenever the baked chunks go over the memory budget '''
+
+    def __init__(self, layers, radius, memory_budget, builds_per_frame=STREAM_BUILDS_PER_FRAME):
+
+        # the Chunked_Layer of every map layer
+        self.layers = [layer[0] for layer in layers.values()]
+        self.radius = radius
+        self.memory_budget = memory_budget
+        self.builds_per_frame = builds_per_frame
+
+        # the chunk the player was last in, nothing is streamed until it changes
+        self.center = None
+
+        # when each chunk was last near the player, keyed by (layer, col, row)
+        self.last_used = {}
+        self.tick = 0
+
+        # chunks waiting to be planned by the background thread, and the
+        # plans it hands back to be built. Only the main thread touches surfaces
+        self.pending = set()
+        self.plan_queue = queue.Queue()
+        self.planned = queue.Queue()
+        self.thread = threading.Thread(target=self.plan_chunks, daemon=True)
+        self.thread.start()
+
+    def plan_chunks(self):
+        ''' runs on the background thread, planning queued chunks until stopped '''
+
+        while True:
+            job = self.plan_queue.get()
+            if job == None:
+                return
+            layer, col, row = job
+            self.planned.put((job, layer.plan_chunk(col, row)))
+
+    def build_planned(self):
+        ''' builds up to builds_per_frame of the planned chunks, skipping
+            those which were baked while they were being planned '''
+
+        for _ in range(self.builds_per_frame):
+            try:
+                job, plan = self.planned.get_nowait()
+            except queue.Empty:
+                return
+            self.pending.discard(job)
+            layer, col, row = job
+            if (col, row) not in layer.chunks:
+                layer.build_chunk(col, row, plan)
+
+    def stop(self):
+        ''' ends the background thread '''
+
+        self.plan_queue.put(None)
+
+    def update(self, pos_x, pos_y):
+        ''' builds the chunks planned so far, prefetches the chunks around
+            the position once it enters a new chunk, then evicts distant
+            chunks over the budget '''
+
+        if not self.layers:
+            return
+
+        self.build_planned()
+
+        chunk_width, chunk_height = self.layers[0].chunk_width, self.layers[0].chunk_height
+        center = (int(pos_x // chunk_width), int(pos_y // chunk_height))
+        if center == self.center:
+            return
+        self.center = center
+        self.tick += 1
+
+        for layer in self.layers:
+            last_col = (layer.width - 1) // CHUNK_SIZE
+            last_row = (layer.height - 1) // CHUNK_SIZE
+            for row in range(max(0, center[1] - self.radius), min(last_row, center[1] + self.radius) + 1):
+                for col in range(max(0, center[0] - self.radius), min(last_col, center[0] + self.radius) + 1):
+                    job = (layer, col, row)
+                    self.last_used[job] = self.tick
+                    if (col, row) not in layer.chunks and job not in self.pending:
+                        self.pending.add(job)
+                        self.plan_queue.put(job)
+
+        self.evict()
+
+    def memory_usage(self):
+        ''' returns the bytes used by every baked chunk '''
+
+        usage = 0
+        for layer in self.layers:
+            for chunk in layer.chunks.values():
+                if chunk != None:
+                    usage += chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+        return usage
+
+    def evict(self):
+        ''' drops the chunks outside the radius which were used longest ago
+            until the baked chunks fit in the memory budget '''
+
+        usage = self.memory_usage()
+        if usage <= self.memory_budget:
+            return
+
+        # every baked chunk outside the radius, least recently used first
+        distant = []
+        for layer in self.layers:
+            for col, row in layer.chunks:
+                if max(abs(col - self.center[0]), abs(row - self.center[1])) > self.radius:
+                    distant.append((self.last_used.get((layer, col, row), 0), id(layer), layer, col, row))
+        distant.sort(key=lambda chunk: chunk[:2])
+
+        for _, _, layer, col, row in distant:
+            if usage <= self.memory_budget:
+                break
+            chunk = layer.chunks.pop((col, row), None)
+            layer.tile_counts.pop((col, row), None)
+            self.last_used.pop((layer, col, row), None)
+            if chunk != None:
+                usage -= chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+
+class Collision_Grid():
+    ''' one byte per map cell, set if a tile of any collision layer
+        is in the cell. Queries only look at the cells a rect covers '''
+
+    def __init__(self, width, height, tilewidth, tileheight):
+
+        # size of the map in cells
+        self.width = width
+        self.height = height
+
+        # size of a cell in pixels
+        self.tilewidth = tilewidth
+        self.tileheight = tileheight
+
+        # row by row, 1 if the cell is blocked. Loaded maps view
+        # the cells straight from their memory-mapped cache
+        self.cells = bytearray(width * height)
+
+    def add_layer(self, data):
+        ''' marks every cell holding a tile of the layer's data as blocked '''
+
+        cells = self.cells
+        for data_pos in range(len(data)):
+            if data[data_pos] > 0:
+                cells[data_pos] = 1
+
+    def nearest_cell(self, pos_x, pos_y):
+        ''' returns the cell whose corner is nearest the position, or None off the map '''
+
+        col = int((pos_x + self.tilewidth // 2) // self.tilewidth)
+        row = int((pos_y + self.tileheight // 2) // self.tileheight)
+        if 0 <= col < self.width and 0 <= row < self.height:
+            return row * self.width + col
+        return None
+
+    def is_blocked(self, rect):
+        ''' returns True if the rect overlaps a blocked cell '''
+
+        # range of cells covered by the rect, nothing outside the map blocks
+        first_col = max(0, rect.left // self.tilewidth)
+        last_col = min(self.width - 1, (rect.right - 1) // self.tilewidth)
+        first_row = max(0, rect.top // self.tileheight)
+        last_row = min(self.height - 1, (rect.bottom - 1) // self.tileheight)
+        if first_col > last_col:
+            return False
+
+        for row in range(first_row, last_row + 1):
+            row_start = row * self.width
+            if any(self.cells[row_start + first_col:row_start + last_col + 1]):
+                return True
+        return False
+
+    def first_hit_along(self, rect, direction, distance):
+        ''' returns how far the rect can be moved in the direction before
+            it overlaps a blocked cell, or None if it can move the whole distance '''
+
+        step_x, step_y = DIRECTION_VECTOR[direction]
+
+        # the covered cells only change when an edge of the rect crosses
+        # into the next column or row, so those are the only steps tested
+        steps = set()
+        if step_x > 0:
+            steps.update(range(self.tilewidth - (rect.right - 1) % self.tilewidth, distance + 1, self.tilewidth))
+        elif step_x < 0:
+            steps.update(range(rect.left % self.tilewidth + 1, distance + 1, self.tilewidth))
+        if step_y > 0:
+            steps.update(range(self.tileheight - (rect.bottom - 1) % self.tileheight, distance + 1, self.tileheight))
+        elif step_y < 0:
+            steps.update(range(rect.top % self.tileheight + 1, distance + 1, self.tileheight))
+
+        if self.is_blocked(rect):
+            return 0
+        for step in sorted(steps):
+            if self.is_blocked(rect.move(step_x * step, step_y * step)):
+                return step - 1
+        return None
+
+class Flow_Field():
+    ''' Dijkstra map over the collision grid of the steps towards a goal,
+        shared by everything heading there. A cell is clear when an agent
+        of the given size, and a margin around it, can stand with its
+        top-left on the cell's corner.
+        The field is only searched again when the goal crosses into another
+        cell, and then only FLOW_FIELD_RADIUS cells around it, so reading
+        the next step of a cell is a single lookup '''
+
+    def __init__(self, collision_grid, size, radius=FLOW_FIELD_RADIUS, margin=FLOW_FIELD_MARGIN):
+
+        self.collision_grid = collision_grid
+        self.radius = radius
+        self.margin = margin
+
+        # the rect of an agent with its margin, moved to each cell to test if it is clear
+        self.agent = pygame.Rect(0, 0, size[0] + 2 * margin, size[1] + 2 * margin)
+
+        # 0 until a search first needs the cell, then 1 if clear and 2 if blocked
+        cells = collision_grid.width * collision_grid.height
+        self.clear = bytearray(cells)
+
+        # the direction to step in from each cell, only valid for the cells
+        # whose searched number is the number of the last search
+        self.directions = bytearray(cells)
+        self.searched = array.array('I', bytes(4 * cells))
+        self.search = 0
+
+        # the cell the field leads to
+        self.goal = None
+
+    def is_clear(self, cell):
+        ''' returns True if an agent standing on the cell hits nothing '''
+
+        if self.clear[cell] == 0:
+            grid = self.collision_grid
+            self.agent.topleft = ((cell % grid.width) * grid.tilewidth - self.margin,
+                                  (cell // grid.width) * grid.tileheight - self.margin)
+            self.clear[cell] = 2 if grid.is_blocked(self.agent) else 1
+        return self.clear[cell] == 1
+
+    def update(self, pos_x, pos_y):
+        ''' searches the field again if the goal has moved into another
+            cell, and returns True if it did '''
+
+        goal = self.collision_grid.nearest_cell(pos_x, pos_y)
+        if goal == self.goal:
+            return False
+        self.goal = goal
+        self.search += 1
+        if goal == None:
+            return True
+
+        width = self.collision_grid.width
+        height = self.collision_grid.height
+        goal_col, goal_row = goal % width, goal // width
+        first_col, last_col = max(0, goal_col - self.radius), min(width - 1, goal_col + self.radius)
+        first_row, last_row = max(0, goal_row - self.radius), min(height - 1, goal_row + self.radius)
+        search, searched, directions = self.search, self.searched, self.directions
+
+        # breadth first from the goal, every step costs the same
+        searched[goal] = search
+        directions[goal] = STOP
+        frontier = [goal]
+        while frontier:
+            next_frontier = []
+            for cell in frontier:
+                col, row = cell % width, cell // width
+                for direction in DIRECTIONS:
+                    step_x, step_y = DIRECTION_VECTOR[direction]
+                    next_col, next_row = col - step_x, row - step_y
+                    if not (first_col <= next_col <= last_col and first_row <= next_row <= last_row):
+                        continue
+                    next_cell = next_row * width + next_col
+                    if searched[next_cell] == search or not self.is_clear(next_cell):
+                        continue
+
+                    # diagonal steps can't cut the corner of a blocked cell
+                    if step_x and step_y and not (self.is_clear(next_row * width + col) and
+                                                  self.is_clear(row * width + next_col)):
+                        continue
+
+                    # the cell steps in the direction leading back here
+                    searched[next_cell] = search
+                    directions[next_cell] = direction
+                    next_frontier.append(next_cell)
+            frontier = next_frontier
+        return True
+
+    def next_target(self, pos_x, pos_y, goal_x, goal_y):
+        ''' returns the corner of the next cell on the way to the goal, or
+            the goal itself when it is in reach or the field doesn't lead there '''
+
+        cell = self.collision_grid.nearest_cell(pos_x, pos_y)
+        if cell == None or cell == self.goal or self.searched[cell] != self.search:
+            return (goal_x, goal_y)
+
+        grid = self.collision_grid
+        step_x, step_y = DIRECTION_VECTOR[self.directions[cell]]
+        return (((cell % grid.width) + step_x) * grid.tilewidth, ((cell // grid.width) + step_y) * grid.tileheight)
+
+class Path_Graph():
+    ''' hierarchical path finding over the clear cells of a map, cells
+        with PATH_CLEARANCE free cells on every side. The map is cut into
+        clusters, and the clear cells of a cluster which join up inside it
+        into regions. The region of every cell and the graph of the portals
+        between neighbouring regions, with the length of the way between
+        the portals of one region, are built by compile_map and loaded
+        with the map. A path is found on the portal graph first, then each
+        leg between two portals is searched for only inside their clusters
+        when the walker reaches it. Routes between two regions are kept
+        in an LRU cache, so most paths cost one cache lookup '''
+
+    def __init__(self, collision_grid, regions, cluster_size, nodes, edges, cache_size=PATH_CACHE_SIZE):
+
+        self.collision_grid = collision_grid
+        self.cluster_size = cluster_size
+        self.clusters_wide = -(-collision_grid.width // cluster_size)
+
+        # the cell of every portal, and its neighbours with the length of the way there
+        self.nodes = nodes
+        self.neighbours = [[] for node in nodes]
+        for index in range(0, len(edges), 3):
+            node_a, node_b, cost = edges[index:index + 3]
+            self.neighbours[node_a].append((node_b, cost))
+            self.neighbours[node_b].append((node_a, cost))
+
+        # the region of every cell, 0 if it isn't clear, and the portals of each region
+        self.regions = regions
+        self.node_region = [regions[cell] for cell in nodes]
+        self.region_nodes = {}
+        for node, region in enumerate(self.node_region):
+            self.region_nodes.setdefault(region, []).append(node)
+
+        # portal routes by (start region, goal region), least recently used first
+        self.routes = collections.OrderedDict()
+        self.cache_size = cache_size
+
+    def cluster(self, cell):
+        ''' returns the cluster holding the cell '''
+
+        width, size = self.collision_grid.width, self.cluster_size
+        return ((cell // width) // size) * self.clusters_wide + (cell % width) // size
+
+    def cluster_bounds(self, cluster):
+        ''' returns the first and last column and row of the cluster '''
+
+        grid, size = self.collision_grid, self.cluster_size
+        first_col = (cluster % self.clusters_wide) * size
+        first_row = (cluster // self.clusters_wide) * size
+        return (first_col, min(grid.width, first_col + size) - 1,
+                first_row, min(grid.height, first_row + size) - 1)
+
+    def route(self, start_region, goal_region):
+        ''' returns the portals on the shortest way from any portal of the
+            start region to one of the goal region, or None if there is
+            no way there '''
+
+        key = (start_region, goal_region)
+        if key in self.routes:
+            self.routes.move_to_end(key)
+            return self.routes[key]
+
+        # dijkstra over the portal graph, leaving from every start portal at once
+        costs = {}
+        previous = {}
+        heap = []
+        for node in self.region_nodes.get(start_region, []):
+            costs[node] = 0
+            previous[node] = None
+            heap.append((0, node))
+        heapq.heapify(heap)
+
+        route = None
+        while heap:
+            cost, node = heapq.heappop(heap)
+            if cost > costs[node]:
+                continue
+            if self.node_region[node] == goal_region:
+                route = []
+                while node != None:
+                    route.append(node)
+                    node = previous[node]
+                route.reverse()
+                break
+            for next_node, step_cost in self.neighbours[node]:
+                next_cost = cost + step_cost
+                if next_cost < costs.get(next_node, next_cost + 1):
+                    costs[next_node] = next_cost
+                    previous[next_node] = node
+                    heapq.heappush(heap, (next_cost, next_node))
+
+        self.routes[key] = route
+        if len(self.routes) > self.cache_size:
+            self.routes.popitem(last=False)
+        return route
+
+    def find_path(self, pos_x, pos_y, goal_x, goal_y):
+        ''' returns the cells a walker at the position passes on its way to
+            the goal, portals then the goal's cell, or None if either is not
+            on a clear cell or there is no way there '''
+
+        grid = self.collision_grid
+        start = grid.nearest_cell(pos_x, pos_y)
+        goal = grid.nearest_cell(goal_x, goal_y)
+        if start == None or goal == None or not self.regions[start] or not self.regions[goal]:
+            return None
+
+        # every cell of a region can be reached from the others inside its cluster
+        start_region, goal_region = self.regions[start], self.regions[goal]
+        if start_region == goal_region:
+            return [goal]
+
+        route = self.route(start_region, goal_region)
+        if route == None:
+            return None
+        return [self.nodes[node] for node in route] + [goal]
+
+    def local_path(self, start, goal):
+        ''' returns the cells after start on the shortest way to goal,
+            searching only the clusters holding them, or None if there is
+            no way there inside them '''
+
+        if start == goal:
+            return []
+
+        width = self.collision_grid.width
+        start_bounds = self.cluster_bounds(self.cluster(start))
+        goal_bounds = self.cluster_bounds(self.cluster(goal))
+        bounds = (min(start_bounds[0], goal_bounds[0]), max(start_bounds[1], goal_bounds[1]),
+                  min(start_bounds[2], goal_bounds[2]), max(start_bounds[3], goal_bounds[3]))
+        goal_col, goal_row = goal % width, goal // width
+
+        # a* with the number of steps left as the estimate, diagonals cost one step
+        costs = {start: 0}
+        previous = {start: None}
+        heap = [(0, 0, start)]
+        while heap:
+            estimate, cost, cell = heapq.heappop(heap)
+            if cell == goal:
+                path = []
+                while cell != start:
+                    path.append(cell)
+                    cell = previous[cell]
+                path.reverse()
+                return path
+            if cost > costs[cell]:
+                continue
+            for next_cell in clear_neighbours(self.regions, width, cell, bounds):
+                next_cost = cost + 1
+                if next_cost < costs.get(next_cell, next_cost + 1):
+                    costs[next_cell] = next_cost
+                    previous[next_cell] = cell
+                    left = max(abs(next_cell % width - goal_col), abs(next_cell // width - goal_row))
+                    heapq.heappush(heap, (next_cost + left, next_cost, next_cell))
+        return None
+
+    def next_target(self, pos_x, pos_y, route, steps):
+        ''' takes the next cell of a walker's path and returns its corner.
+            steps are the cells left of the leg being walked, and the leg
+            to the next cell of route is searched when they run out. Both
+            lists are emptied and (None, None) returned when the walker
+            can't get any further '''
+
+        grid = self.collision_grid
+        while len(steps) == 0 and len(route) > 0:
+            start = grid.nearest_cell(pos_x, pos_y)
+            leg = None
+            if start != None and self.regions[start]:
+                leg = self.local_path(start, route.pop(0))
+            if leg == None:
+                del route[:]
+                return (None, None)
+            steps.extend(leg)
+
+        if len(steps) == 0:
+            return (None, None)
+        cell = steps.pop(0)
+        return ((cell % grid.width) * grid.tilewidth, (cell // grid.width) * grid.tileheight)
+
+class Spatial_Hash():
+    ''' uniform grid over the world holding the live characters in
+        every cell their rect overlaps. An object is only moved
+        between cells when the cells its rect covers change. Queries
+        return objects in the order they were first stored '''
+
+    def __init__(self, cell_size):
+
+        # size of a cell in pixels
+        self.cell_size = cell_size
+
+        # sets of objects, keyed by (cell column, cell row)
+        self.buckets = {}
+
+        # the range of cells each object is stored in
+        self.object_cells = {}
+
+        # when each live object was first stored, numbered from 0
+        self.order = {}
+        self.stored = 0
+
+    def get_cell_range(self, rect):
+        ''' returns the first column, first row, last column and last row
+            of the cells covered by the rect '''
+
+        size = self.cell_size
+        return (rect.left // size, rect.top // size,
+                (rect.right - 1) // size, (rect.bottom - 1) // size)
+
+    def update(self, obj):
+        ''' stores the object in the cells its rect covers, objects
+            which are no longer alive are removed '''
+
+        if not obj.alive():
+            self.remove(obj)
+            self.order.pop(obj, None)
+            return
+
+        if obj not in self.order:
+            self.order[obj] = self.stored
+            self.stored += 1
+
+        cell_range = self.get_cell_range(obj.rect)
+        if self.object_cells.get(obj) == cell_range:
+            return
+
+        self.remove(obj)
+        first_col, first_row, last_col, last_row = cell_range
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                self.buckets.setdefault((col, row), set()).add(obj)
+        self.object_cells[obj] = cell_range
+
+    def remove(self, obj):
+        ''' takes the object out of all of its cells '''
+
+        cell_range = self.object_cells.pop(obj, None)
+        if cell_range == None:
+            return
+
+        first_col, first_row, last_col, last_row = cell_range
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                bucket = self.buckets[(col, row)]
+                bucket.discard(obj)
+                if not bucket:
+                    del self.buckets[(col, row)]
+
+    def query_rect(self, rect):
+        ''' returns the list of objects overlapping the rect '''
+
+        found = set()
+        first_col, first_row, last_col, last_row = self.get_cell_range(rect)
+        for row in range(first_row, last_row + 1):
+            for col in range(first_col, last_col + 1):
+                bucket = self.buckets.get((col, row))
+                if bucket:
+                    found.update(bucket)
+
+        return sorted((obj for obj in found if rect.colliderect(obj.rect)), key=self.order.__getitem__)
+
+    def query_radius(self, x, y, radius):
+        ''' returns the objects whose rect is within radius of x, y, as
+            the keys of a dict so they keep their order '''
+
+        found = {}
+        area = pygame.Rect(x - radius, y - radius, 2 * radius + 1, 2 * radius + 1)
+        for obj in self.query_rect(area):
+            # distance to the closest point of the rect
+            closest_x = min(max(x, obj.rect.left), obj.rect.right - 1)
+            closest_y = min(max(y, obj.rect.top), obj.rect.bottom - 1)
+            if (closest_x - x) ** 2 + (closest_y - y) ** 2 <= radius ** 2:
+                found[obj] = None
+
+        return found
+
+class Asset_Loader():
+    ''' reads and decodes asset files on a pool of worker threads. pygame
+        can only convert surfaces on the main thread, so each decoded asset
+        is finished there by pump(), a little each frame. Assets are
+        requested in groups, and a group is ready once all of its assets
+        are finished, so the game can start before everything is loaded '''
+
+    def __init__(self, workers=ASSET_WORKERS):
+
+        # requests waiting for a thread, and decoded assets waiting to be finished
+        self.jobs = queue.Queue()
+        self.decoded = queue.Queue()
+
+        # finished assets and the errors of failed ones, keyed by name
+        self.assets = {}
+        self.errors = {}
+
+        # the names of the assets of each group
+        self.groups = collections.defaultdict(list)
+
+        self.threads = [threading.Thread(target=self.decode, daemon=True) for worker in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def decode(self):
+        ''' runs on a worker thread, decoding requested assets until stopped '''
+
+        while True:
+            job = self.jobs.get()
+            if job == None:
+                return
+            name, decode, args, finish = job
+            try:
+                self.decoded.put((name, decode(*args), finish, None))
+            except Exception as error:
+                self.decoded.put((name, None, finish, error))
+
+    def stop(self):
+        ''' ends the worker threads '''
+
+        for thread in self.threads:
+            self.jobs.put(None)
+
+    def request(self, name, group, decode, args=(), finish=None):
+        ''' calls decode(*args) on a worker thread, then finish with what
+            it returned on the main thread. The asset is what finish
+            returns, or what decode returned when there is no finish '''
+
+        self.groups[group].append(name)
+        self.jobs.put((name, decode, args, finish))
+
+    def pump(self, time_limit=ASSET_FINISH_TIME):
+        ''' finishes decoded assets on the main thread, until there are
+            none left or time_limit seconds have passed '''
+
+        start = time.perf_counter()
+        while time.perf_counter() - start < time_limit:
+            try:
+                name, asset, finish, error = self.decoded.get_nowait()
+            except queue.Empty:
+                return
+
+            if error == None and finish != None:
+                try:
+                    asset = finish(asset)
+                except Exception as finish_error:
+                    error = finish_error
+
+            if error != None:
+                self.errors[name] = error
+            else:
+                self.assets[name] = asset
+
+    def finished(self, name):
+        ''' returns True once the asset loaded or failed '''
+
+        return name in self.assets or name in self.errors
+
+    def ready(self, group):
+        ''' returns True once every asset of the group is finished '''
+
+        return all(self.finished(name) for name in self.groups[group])
+
+    def progress(self, *groups):
+        ''' returns the share of the assets of the groups which are finished '''
+
+        names = [name for group in groups for name in self.groups[group]]
+        if not names:
+            return 1.0
+        return sum(1 for name in names if self.finished(name)) / len(names)
+
+    def get(self, name):
+        ''' returns a finished asset, raising the error it failed with '''
+
+        if name in self.errors:
+            raise self.errors[name]
+        return self.assets[name]
+
+class Audio():
+    ''' plays the game's sound. The music is streamed from disk by
+        pygame.mixer.music, so only a small buffer of it is in memory.
+        Each effect file is decoded once and shared. The effects play on
+        a fixed pool of reserved channels: a new effect takes a free
+        channel, or steals the one playing the lowest priority effect,
+        oldest first, which is no higher than its own. Without a mixer,
+        as when headless, nothing plays '''
+
+    def __init__(self, effects=SOUND_EFFECTS, channels=SOUND_CHANNELS):
+
+        self.enabled = pygame.mixer.get_init() != None
+        self.effects = effects
+
+        # decoded effects, keyed by file
+        self.sounds = {}
+
+        # the channel pool, and the priority of what each is playing and when it started
+        self.channels = []
+        if self.enabled:
+            pygame.mixer.set_num_channels(channels)
+            pygame.mixer.set_reserved(channels)
+            self.channels = [pygame.mixer.Channel(index) for index in range(channels)]
+        self.priorities = [0] * len(self.channels)
+        self.started = [0] * len(self.channels)
+        self.count = 0
+
+        # the last batch of events each effect played in, an effect plays once a batch
+        self.batch = 0
+        self.played = dict((name, -1) for name in effects)
+
+    def load_effects(self, loader=None, group='audio'):
+        ''' decodes every effect file once, on the loader's threads when given '''
+
+        if not self.enabled:
+            return
+
+        for file, priority in self.effects.values():
+            if file in self.sounds:
+                continue
+            if loader == None:
+                self.sounds[file] = pygame.mixer.Sound(file)
+            elif file not in loader.groups[group]:
+                loader.request(file, group, pygame.mixer.Sound, (file,),
+                               lambda sound, file=file: self.sounds.setdefault(file, sound))
+
+    def play_music(self, music_file=MUSIC_FILE):
+        ''' streams the music from disk, looping forever '''
+
+        if self.enabled:
+            pygame.mixer.music.load(music_file)
+            pygame.mixer.music.play(-1)
+
+    def play(self, name):
+        ''' plays an effect on the pool, returns False when it is not loaded
+            or every channel is playing something more important '''
+
+        file, priority = self.effects[name]
+        sound = self.sounds.get(file)
+        if sound == None:
+            return False
+
+        # a free channel, else the lowest priority one which started first
+        chosen = None
+        for index in range(len(self.channels)):
+            if not self.channels[index].get_busy():
+                chosen = index
+                break
+            if self.priorities[index] <= priority and (chosen == None or
+                    (self.priorities[index], self.started[index]) < (self.priorities[chosen], self.started[chosen])):
+                chosen = index
+        if chosen == None:
+            return False
+
+        self.count += 1
+        self.priorities[chosen] = priority
+        self.started[chosen] = self.count
+        self.channels[chosen].play(sound)
+        return True
+
+    def play_events(self, names):
+        ''' plays the effects of a batch of game events, each effect once '''
+
+        self.batch += 1
+        for name in names:
+            if self.played[name] != self.batch:
+                self.played[name] = self.batch
+                self.play(name)
+
+class Animation_Bank():
+    ''' loads each animation once and shares its frames with every object
+        using it. Frame tables are tuples of rows, so they are read-only.
+        The layout of each animation and the actions of each character
+        come from ANIMATION_FILE, and the frames from the packed atlas
+        when one has been built '''
+
+    def __init__(self, spec_file=ANIMATION_FILE, atlas_file=ATLAS_FILE):
+
+        # layout of every animation and the actions of every character, keyed by name
+        spec = json.loads(open(spec_file).read())
+        self.spec = spec["animations"]
+        self.characters = spec["characters"]
+
+        # character definitions, made when a character is first used
+        self.definitions = {}
+
+        # frame tables cut from the atlas, empty if it was never packed,
+        # and the animations in it, known before a preloaded atlas is cut
+        self.atlas_animations = {}
+        self.atlas_names = set()
+        if atlas_file != None and os.path.exists(atlas_file):
+            self.atlas_animations = load_atlas(atlas_file)
+            self.atlas_names.update(self.atlas_animations)
+
+        # frame tables, keyed by animation name
+        self.animations = {}
+
+        # the objects using each animation, dead objects drop out by themselves
+        self.users = {}
+
+    def load(self, name):
+        ''' returns the frame table of an animation, loading it the first time '''
+
+        table = self.animations.get(name)
+
+        if table == None:
+            anim = self.spec[name]
+
+            if name in self.atlas_animations:
+                table = self.atlas_animations[name]
+                self.animations[name] = table
+                self.users[name] = weakref.WeakSet()
+            else:
+                if "sheet" in anim:
+                    img_lst = slice_sheet(anim)
+                else:
+                    img_lst = create_sprite_frames(anim["directory"], anim["prefix"], tuple(anim["colorkey"]))
+                table = self.add_animation(name, img_lst)
+
+        return table
+
+    def preload_atlas(self, loader, group, atlas_file=ATLAS_FILE):
+        ''' decodes the atlas image on the loader's threads, for a bank
+            made without an atlas_file. Its animations are not preloaded
+            from their own files '''
+
+        if not os.path.exists(atlas_file):
+            return
+
+        manifest = json.loads(open(atlas_file).read())
+        self.atlas_names.update(manifest["animations"])
+        loader.request(manifest["image"], group, pygame.image.load, (manifest["image"],),
+                       lambda image: self.set_atlas(manifest, image))
+
+    def set_atlas(self, manifest, image):
+        ''' cuts the frames of a decoded atlas image, on the main thread '''
+
+        self.atlas_animations.update(cut_atlas(manifest, image))
+        return self.atlas_animations
+
+    def preload(self, loader, group, character):
+        ''' decodes the animations of a character on the loader's threads.
+            load() finds them once the loader has finished them '''
+
+        for action in self.characters[character]["actions"]:
+            name = action["animation"]
+            # the atlas holds it, and actions can share an animation
+            if name in self.animations or name in self.atlas_names or name in loader.groups[group]:
+                continue
+            loader.request(name, group, decode_animation, (self.spec[name],),
+                           lambda images, name=name: self.add_animation(name, convert_animation(self.spec[name], images)))
+
+    def add_animation(self, name, img_lst):
+        ''' stores the frame table of an animation from its frames, row by row '''
+
+        anim = self.spec[name]
+        rows, cols = anim["rows"], anim["cols"]
+        table = tuple(tuple(img_lst[row * cols:(row + 1) * cols]) for row in range(rows))
+        if name not in self.animations:
+            self.animations[name] = table
+            self.users[name] = weakref.WeakSet()
+        return self.animations[name]
+
+    def definition(self, name):
+        ''' returns the definition of a character, loading its animations
+            the first time '''
+
+        definition = self.definitions.get(name)
+        if definition == None:
+            definition = Character_Definition(self.characters[name], self)
+            self.definitions[name] = definition
+        return definition
+
+    def define(self, obj, name):
+        ''' gives the object the definition of a character '''
+
+        definition = self.definition(name)
+        obj.definition = definition
+        for action in definition.actions:
+            self.users[action.animation].add(obj)
+        return definition
+
+    def memory_usage(self):
+        ''' returns the bytes of pixel data used by each animation '''
+
+        usage = {}
+        for name, table in self.animations.items():
+            usage[name] = sum(img.get_width() * img.get_height() * img.get_bytesize()
+                              for row in table for img in row)
+        return usage
+
+    def evict_unused(self):
+        ''' forgets every animation no live object uses, returns how many '''
+
+        unused = [name for name, users in self.users.items() if len(users) == 0]
+        for name in unused:
+            del self.animations[name]
+            del self.users[name]
+
+        # definitions hold the frames of their animations
+        for name, definition in list(self.definitions.items()):
+            if any(action.animation in unused for action in definition.actions):
+                del self.definitions[name]
+        return len(unused)
+
+class Character_Action():
+    ''' one action of a character definition. frames holds the frames of
+        each direction by direction index, and anchors the offset of the
+        object's rect from its position and the rect's size for each frame.
+        One-shot actions end before their last frame, by killing the
+        object or by going back to the base action after a cooldown '''
+
+    def __init__(self, spec, frames, anchor, size):
+
+        self.name = spec["action"]
+        self.animation = spec["animation"]
+
+        # the attribute which starts the action, the base action has none
+        self.state = spec.get("state")
+
+        # looping actions, walking ones only play while there is a target
+        self.loop = spec.get("loop", False)
+        self.walk = spec.get("walk", False)
+
+        # how one-shot actions end
+        self.cooldown = spec.get("cooldown", 0)
+        self.kill = spec.get("kill", False)
+
+        # the frame on which the action deals damage, if it does
+        self.damage_frame = spec.get("damage_frame")
+
+        # the frame on which the action casts its range attack, if it does
+        self.cast_frame = spec.get("cast_frame")
+
+        self.frames = frames
+        self.count = len(frames[DOWN])
+
+        # anchors are worked out once here instead of every frame
+        self.anchors = None
+        if anchor != None:
+            self.anchors = [[get_anchor(anchor, direction, image.get_size(), size) for image in frames[direction]]
+                            for direction in DIRECTIONS]
+
+class Character_Definition():
+    ''' the actions of a character, read from the "characters" section of
+        ANIMATION_FILE. They are tried in order each frame, the first whose
+        state is set plays, and the last is the base action played when
+        no other is '''
+
+    def __init__(self, spec, animation_bank):
+
+        # frames of every action by direction index
+        frames = {}
+        for action in spec["actions"]:
+            table = animation_bank.load(action["animation"])
+            frames[action["animation"]] = direction_rows(table, animation_bank.spec[action["animation"]].get("directions"))
+
+        # objects anchored by their top-left keep the size of the first base frame
+        self.size = frames[spec["actions"][-1]["animation"]][DOWN][0].get_size()
+
+        self.actions = [Character_Action(action, frames[action["animation"]], action.get("anchor", spec.get("anchor")), self.size)
+                        for action in spec["actions"]]
+
+    def action(self, name):
+        ''' returns the action with the name '''
+
+        for action in self.actions:
+            if action.name == name:
+                return action
+
+class Camera():
+    ''' owns the view offset. Everything in the game keeps its world
+        co-ordinates and is only translated to the screen when drawn '''
+
+    def __init__(self, width, height):
+
+        # the area of the world shown on the screen
+        self.rect = pygame.Rect(0, 0, width, height)
+
+    def follow(self, obj):
+        ''' centers the view on the world position of the object '''
+
+        self.rect.center = (obj.pos_x, obj.pos_y)
+
+    def apply(self, rect):
+        ''' returns a world rect translated to the screen '''
+
+        return rect.move(-self.rect.x, -self.rect.y)
+
+    def screen_to_world(self, pos):
+        ''' returns a screen position translated to the world '''
+
+        return (pos[0] + self.rect.x, pos[1] + self.rect.y)
+
+class Render_Queue():
+    ''' everything drawn in a frame, submitted as (surface, dest, layer,
+        sort key) entries. flush() draws them sorted by layer and then by
+        key, in as few Surface.blits calls as it can. Characters are keyed
+        by the bottom of their image, so those further down the screen
+        are drawn in front. Entries of equal layer and key keep the order
+        they were submitted in '''
+
+    # the layers, drawn in this order
+    GROUND, ACTORS, ABOVE, OVERLAY = 0, 1, 2, 3
+
+    def __init__(self):
+
+        # (layer, key, submission order, surface, dest), and whether they are in order
+        self.entries = []
+        self.sorted = True
+
+        # the (surface, dest) pairs in drawing order, made once per frame
+        self.blit_lst = []
+
+    def clear(self):
+        ''' starts a new frame '''
+
+        del self.entries[:]
+        del self.blit_lst[:]
+        self.sorted = True
+
+    def submit(self, surface, dest, layer, key=0):
+        ''' adds a surface drawn at dest '''
+
+        self.entries.append((layer, key, len(self.entries), surface, dest))
+        self.sorted = False
+
+    def flush(self, surface):
+        ''' draws every entry onto the surface, it can be flushed again
+            under another clip '''
+
+        if not self.sorted:
+            self.entries.sort()
+            self.blit_lst = [(entry[3], entry[4]) for entry in self.entries]
+            self.sorted = True
+
+        # pygame-ce blits faster when it returns no rects
+        if hasattr(surface, 'fblits'):
+            surface.fblits(self.blit_lst)
+        else:
+            surface.blits(self.blit_lst, False)
+
+class Dirty_Renderer():
+    ''' redraws only the parts of the screen which changed since the last
+        frame, and returns them for display.update(rects). A part changed
+        when a sprite or an overlay image in it moved, changed image,
+        appeared or went away. The whole screen is redrawn when the
+        camera moves, or when too much of it changed '''
+
+    def __init__(self, enabled=DIRTY_RENDERING):
+
+        self.enabled = enabled
+
+        # the camera position, sprites and overlay images of the last frame
+        self.view = None
+        self.sprites = {}
+        self.overlay = set()
+
+        # map chunks and the tiles in them drawn in the last frame
+        self.chunks = 0
+        self.tiles = 0
+
+        # everything drawn in a frame, kept for every part redrawn
+        self.queue = Render_Queue()
+
+    def invalidate(self):
+        ''' redraws the whole screen next frame '''
+
+        self.view = None
+
+    def draw(self, surface, world, camera, overlay, alpha=1.0):
+        ''' draws the world, alpha of the way through its last tick, and
+            then the overlay, a list of (image, dest) drawn on top in order,
+            and returns the rects of the surface which were redrawn '''
+
+        screen_rect = surface.get_rect()
+
+        # every sprite on the screen with the image and place it is drawn at,
+        # the image can be larger than the sprite's rect
+        sprites = world.visible_sprites(camera, alpha)
+        overlay = [(image, image.get_rect(topleft=(dest[0], dest[1]))) for image, dest in overlay]
+        overlay_set = set((image, tuple(rect)) for image, rect in overlay)
+
+        # everything has to be drawn when the view scrolled
+        if not self.enabled or self.view != camera.rect.topleft:
+            dirty = [screen_rect]
+        else:
+            dirty = []
+            for sprite, drawn in sprites.items():
+                last = self.sprites.get(sprite)
+                if last == None:
+                    dirty.append(drawn[0].get_rect(topleft=drawn[1]))
+                elif last[0] is not drawn[0] or last[1] != drawn[1]:
+                    dirty.append(drawn[0].get_rect(topleft=drawn[1]))
+                    dirty.append(last[0].get_rect(topleft=last[1]))
+            for sprite, last in self.sprites.items():
+                if sprite not in sprites:
+                    dirty.append(last[0].get_rect(topleft=last[1]))
+            for image, rect in self.overlay.symmetric_difference(overlay_set):
+                dirty.append(pygame.Rect(rect))
+            dirty = self.merge(dirty, screen_rect)
+
+            if sum(rect.width * rect.height for rect in dirty) > DIRTY_AREA_LIMIT * screen_rect.width * screen_rect.height:
+                dirty = [screen_rect]
+
+        self.view = camera.rect.topleft
+        self.sprites = sprites
+        self.overlay = overlay_set
+
+        # the frame is queued once, the overlay goes over everything in its order
+        queue = self.queue
+        queue.clear()
+        self.chunks = 0
+        self.tiles = 0
+        if dirty:
+            self.chunks, self.tiles = world.submit(queue, camera, sprites)
+            for image, dest in overlay:
+                queue.submit(image, dest, Render_Queue.OVERLAY)
+
+        # redraw each changed part, the clip keeps every blit inside it
+        for rect in dirty:
+            surface.set_clip(rect)
+            surface.fill(BLACK)
+            queue.flush(surface)
+        surface.set_clip(None)
+
+        return dirty
+
+    def merge(self, rects, bounds):
+        ''' returns the rects clipped to the bounds, with overlapping rects
+            joined so no part is drawn twice '''
+
+        merged = []
+        for rect in rects:
+            rect = rect.clip(bounds)
+            if rect.width == 0 or rect.height == 0:
+                continue
+            index = rect.collidelist(merged)
+            while index != -1:
+                rect.union_ip(merged.pop(index))
+                index = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
+
+class Text_Cache():
+    ''' rendered text surfaces keyed by (font, text, color), so text
+        which doesn't change is only rendered once. The least recently
+        used surface is dropped once more than size are kept '''
+
+    def __init__(self, size=TEXT_CACHE_SIZE):
+
+        self.size = size
+        self.surfaces = collections.OrderedDict()
+
+    def render(self, font, text, color):
+        ''' returns the antialiased text, rendering it the first time '''
+
+        key = (font, text, color)
+        surface = self.surfaces.get(key)
+        if surface == None:
+            surface = font.render(text, True, color)
+            self.surfaces[key] = surface
+            if len(self.surfaces) > self.size:
+                self.surfaces.popitem(last=False)
+        else:
+            self.surfaces.move_to_end(key)
+        return surface
+
+class Hud():
+    ''' the scroll with the player's portrait and stats, composed into
+        one surface which is only composed again when a stat it shows
+        changes, and the tooltip of the monster under the mouse, composed
+        the same way. Each is one overlay image, and keeps its surface
+        while nothing changes so the dirty renderer skips it '''
+
+    def __init__(self, scroll_paper, portrait, font, small_font, text_cache):
+
+        self.scroll_paper = scroll_paper
+        self.portrait = portrait
+        self.font = font
+        self.small_font = small_font
+        self.text_cache = text_cache
+
+        # the composed scroll and the stats it shows
+        self.image = None
+        self.values = None
+
+        # the composed tooltip, its offset from the top middle of the monster and the stats it shows
+        self.tooltip_image = None
+        self.tooltip_offset = (0, 0)
+        self.tooltip_values = None
+
+    def draw(self, player):
+        ''' returns the scroll as an overlay (image, dest), composing it
+            again when the player's stats changed '''
+
+        values = (player.health,)
+        if values != self.values:
+            self.values = values
+            self.image = self.compose(values)
+        return (self.image, (0, 0))
+
+    def compose(self, values):
+        ''' returns a new surface with the scroll, the stats and the portrait '''
+
+        width, height = self.scroll_paper.get_size()
+        health_title = self.text_cache.render(self.font, "Health: ", BLACK)
+        health_state = self.text_cache.render(self.font, str(values[0]), BLACK)
+
+        image = pygame.Surface((width, height), pygame.SRCALPHA)
+        image.blit(self.scroll_paper, (0, 0))
+        image.blit(health_state, health_state.get_rect(center=(width/2+100, height/2)))
+        image.blit(health_title, health_title.get_rect(center=(width/2, height/2)))
+        image.blit(self.portrait, (width/4, height/3))
+        return image.convert_alpha()
+
+    def tooltip(self, monster, sprite_rect):
+        ''' returns the name, health and level of the monster as an overlay
+            (image, dest) above its rect on the screen, composing it again
+            when they changed '''
+
+        values = (monster.name, monster.health, monster.level)
+        if values != self.tooltip_values:
+            self.tooltip_values = values
+            self.compose_tooltip(values)
+        return (self.tooltip_image, (sprite_rect.centerx + self.tooltip_offset[0],
+                                     sprite_rect.y + self.tooltip_offset[1]))
+
+    def compose_tooltip(self, values):
+        ''' composes the tooltip, placed from the top middle of the monster '''
+
+        name, health, level = [self.text_cache.render(self.small_font, str(value), RED) for value in values]
+        name_rect, health_rect, level_rect = name.get_rect(), health.get_rect(), level.get_rect()
+        name_rect.center = (0, -name_rect.height)
+        health_rect.center = (name_rect.x, name_rect.y - health_rect.height)
+        level_rect.x, level_rect.y = (0, health_rect.y)
+
+        area = name_rect.unionall([health_rect, level_rect])
+        image = pygame.Surface(area.size, pygame.SRCALPHA)
+        for text, rect in [(name, name_rect), (health, health_rect), (level, level_rect)]:
+            image.blit(text, rect.move(-area.x, -area.y))
+        self.tooltip_image = image.convert_alpha()
+        self.tooltip_offset = area.topleft
+
+class Frame_Profiler():
+    ''' times the phases of each frame and keeps the last frames in a ring
+        buffer, for the overlay and for chrome trace dumps. A phase runs
+        from its mark() to the next one. While disabled every call only
+        checks a flag '''
+
+    def __init__(self, size=PROFILE_FRAMES):
+
+        # whether frames are timed, only changes between frames
+        self.enabled = False
+        self.timing = False
+
+        # finished frames as (start, end, phases, counts), the oldest is overwritten
+        self.frames = [None] * size
+        self.frame_count = 0
+
+        # the frame being timed and its phases as [name, start, end]
+        self.frame_start = 0
+        self.phases = []
+
+    def toggle(self):
+        ''' turns the profiler on or off from the next frame '''
+
+        self.enabled = not self.enabled
+
+    def begin_frame(self):
+        ''' starts timing a frame if the profiler is on '''
+
+        self.timing = self.enabled
+        if self.timing:
+            self.frame_start = time.perf_counter()
+            self.phases = []
+
+    def mark(self, name):
+        ''' ends the running phase and starts the named one '''
+
+        if not self.timing:
+            return
+        now = time.perf_counter()
+        if self.phases:
+            self.phases[-1][2] = now
+        self.phases.append([name, now, now])
+
+    def end_frame(self, counts=None):
+        ''' ends the last phase and stores the frame with its entity counts '''
+
+        if not self.timing:
+            return
+        now = time.perf_counter()
+        if self.phases:
+            self.phases[-1][2] = now
+        self.frames[self.frame_count % len(self.frames)] = (self.frame_start, now, self.phases, counts)
+        self.frame_count += 1
+        self.timing = False
+
+    def recent(self):
+        ''' returns the stored frames, oldest first '''
+
+        size = len(self.frames)
+        if self.frame_count < size:
+            return self.frames[:self.frame_count]
+        index = self.frame_count % size
+        return self.frames[index:] + self.frames[:index]
+
+    def phase_times(self):
+        ''' returns (phase, mean ms) of every phase in the stored frames,
+            in the order the phases run '''
+
+        totals = {}
+        frames = self.recent()
+        for start, end, phases, counts in frames:
+            for name, phase_start, phase_end in phases:
+                totals[name] = totals.get(name, 0) + phase_end - phase_start
+        return [(name, total * 1000 / len(frames)) for name, total in totals.items()]
+
+    def render(self, font):
+        ''' returns an image of the frame time graph, the mean time of
+            each phase and the counts of the last frame, or None before
+            any frame was timed '''
+
+        frames = self.recent()
+        if not frames:
+            return None
+
+        lines = ["frame %.2f ms" % ((frames[-1][1] - frames[-1][0]) * 1000)]
+        lines += ["%s %.2f ms" % phase for phase in self.phase_times()]
+        if frames[-1][3]:
+            lines += ["%s %d" % count for count in frames[-1][3].items()]
+
+        # the graph is scaled so the frame budget is two thirds of its height
+        graph_height = 60
+        budget = 1.0 / FPS
+        width = len(self.frames) * 2
+        height = graph_height + 4 + len(lines) * (font.get_linesize())
+        panel = pygame.Surface((width, height), SRCALPHA)
+        panel.fill((0, 0, 0, 160))
+
+        for index, frame in enumerate(frames):
+            frame_time = frame[1] - frame[0]
+            bar = min(graph_height, int(frame_time / budget * graph_height * 2 / 3))
+            color = GREEN if frame_time <= budget else RED
+            pygame.draw.rect(panel, color, (index * 2, graph_height - bar, 2, bar))
+        budget_y = graph_height - graph_height * 2 // 3
+        pygame.draw.line(panel, WHITE, (0, budget_y), (width, budget_y))
+
+        y = graph_height + 4
+        for line in lines:
+            panel.blit(font.render(line, True, WHITE), (2, y))
+            y += font.get_linesize()
+
+        return panel
+
+    def dump(self, file=PROFILE_FILE):
+        ''' writes the stored frames as a chrome trace, which can be opened
+            in chrome://tracing or the perfetto ui '''
+
+        frames = self.recent()
+        if not frames:
+            return
+        origin = frames[0][0]
+        events = []
+        for start, end, phases, counts in frames:
+            events.append({ "name": "frame", "ph": "X", "pid": 1, "tid": 1,
+                            "ts": (start - origin) * 1e6, "dur": (end - start) * 1e6 })
+            for name, phase_start, phase_end in phases:
+                events.append({ "name": name, "ph": "X", "pid": 1, "tid": 1,
+                                "ts": (phase_start - origin) * 1e6, "dur": (phase_end - phase_start) * 1e6 })
+            if counts:
+                events.append({ "name": "counts", "ph": "C", "pid": 1, "tid": 1,
+                                "ts": (start - origin) * 1e6, "args": counts })
+
+        with open(file, 'w') as trace:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace)
 
 class Character(pygame.sprite.Sprite):
     ''' super class containing all types of characters in the game '''
@@ -184,6 +1861,7 @@ class Character(pygame.sprite.Sprite):
         # setup the default character states
         self.attack_state = False
         self.give_damage_state = False
+        self.cast_state = False
         self.dead_state = False
         self.collide_state = False
         self.spell_state = False
@@ -198,64 +1876,11 @@ class Character(pygame.sprite.Sprite):
         # setup character default direction
         self.direction = DOWN
 
-        # This holds all the sprite images for each direction
-        self.move_frames_ul = []
-        self.move_frames_ur = []
-        self.move_frames_dl = []
-        self.move_frames_dr = []
-        self.move_frames_l = []
-        self.move_frames_d = []
-        self.move_frames_r = []
-        self.move_frames_u = []
-        
-        self.attack_frames_ul = []
-        self.attack_frames_ur = []
-        self.attack_frames_dl = []
-        self.attack_frames_dr = []
-        self.attack_frames_l = []
-        self.attack_frames_d = []
-        self.attack_frames_r = []
-        self.attack_frames_u = []
-
-        self.spell_frames_ul = []
-        self.spell_frames_ur = []
-        self.spell_frames_dl = []
-        self.spell_frames_dr = []
-        self.spell_frames_l = []
-        self.spell_frames_d = []
-        self.spell_frames_r = []
-        self.spell_frames_u = []
-
-        self.dead_frames = []
-
-        # store all frame tuples in a tuple for processing
-        self.move_tup = (       self.move_frames_u,
-                                self.move_frames_l,
-                                self.move_frames_d,
-                                self.move_frames_r,
-                                self.move_frames_dl,
-                                self.move_frames_ur,
-                                self.move_frames_ul,
-                                self.move_frames_dr   )
-        
-        self.attack_tup = (     self.attack_frames_u,
-                                self.attack_frames_l,
-                                self.attack_frames_d,
-                                self.attack_frames_r,
-                                self.attack_frames_dl,
-                                self.attack_frames_ur,
-                                self.attack_frames_ul,
-                                self.attack_frames_dr   )
-        
-        self.spell_tup = (      self.spell_frames_u,
-                                self.spell_frames_l,
-                                self.spell_frames_d,
-                                self.spell_frames_r,
-                                self.spell_frames_dl,
-                                self.spell_frames_ur,
-                                self.spell_frames_ul,
-                                self.spell_frames_dr   )
+        # the definition of the character, its frames by action and direction
+        self.definition = None
 
+        # the image shown and the anchor placing its rect
+        self.anchor = None
         self.image = None
             
 class Monster(Character):
@@ -268,45 +1893,62 @@ class Monster(Character):
         # by default the monster is not finding the player
         self.find_player_state = False
 
+        # the cells left of the route it wanders along, and of the leg it is on
+        self.route = []
+        self.steps = []
+
+        # the last tick the monster was updated on
+        self.ai_tick = -1
+
         # the name of the monster
         self.name = 'jerry the skeleton'
 
         # the level of the monster
         self.level = 10
 
-    def set_find_player_state(self, player):
+    def set_find_player_state(self, near_player):
         ''' determines if the monster should go looking for the
-            player i.e. the monster is close to the player '''
+            player i.e. the monster is close to the player.
+            near_player holds all objects within AGGRO_RADIUS of the player '''
 
-        # if the player is within 200 
-        if self.pos_y - player.pos_y < 200 and self.pos_x - player.pos_x < 200:
+        # if the player is within AGGRO_RADIUS
+        if self in near_player:
             self.find_player_state = True
 
         # player is too far, don't find them
         else:
             self.find_player_state = False
 
-    def set_target_pos(self, player):
+    def set_target_pos(self, player, flow_field, path_graph):
         ''' determines the target position for the monster '''
 
         # if the monster is attacking it cannot move
         if self.attack_state or self.spell_state:
             self.target_pos = (None,None)
 
-        # if we are within range of the player
+        # if we are within range of the player, follow the flow field around walls
         elif self.find_player_state:
-            self.target_pos = (player.pos_x,player.pos_y)
+            self.target_pos = flow_field.next_target(self.pos_x, self.pos_y, player.pos_x, player.pos_y)
+            del self.route[:]
+            del self.steps[:]
             
-        # setup a random movement pattern by choosing a random target_pos
+        # wander along a route to a random spot, the next cell each time one is reached
         else:
             if self.target_pos == (None,None):
-                    
-                # set a maximum walking distance
-                distance = 100
-                
-                x_range = (self.pos_x - distance, self.pos_x + distance)
-                y_range = (self.pos_y - distance, self.pos_y + distance)
-                self.target_pos = (random.randint(x_range),random.randint(y_range))
+
+                # choose a new spot once the last route is walked
+                if len(self.route) == 0 and len(self.steps) == 0:
+                    x_range = (int(self.pos_x) - WANDER_DISTANCE, int(self.pos_x) + WANDER_DISTANCE)
+                    y_range = (int(self.pos_y) - WANDER_DISTANCE, int(self.pos_y) + WANDER_DISTANCE)
+                    goal = (random.randint(*x_range),random.randint(*y_range))
+                    self.route = path_graph.find_path(self.pos_x, self.pos_y, goal[0], goal[1]) or []
+
+                    # off the path graph, walk straight there
+                    if len(self.route) == 0:
+                        self.target_pos = goal
+                        return
+
+                self.target_pos = path_graph.next_target(self.pos_x, self.pos_y, self.route, self.steps)
     
 class Player(Character):
     ''' player class '''
@@ -318,105 +1960,896 @@ class Player(Character):
         # by default no weapon is equipped
         self.weapon = None
 
+class AI_Scheduler():
+    ''' level of detail for the monsters' thinking. Monsters within
+        AI_NEAR_RADIUS of the player think every tick, those within
+        AI_MID_RADIUS every AI_MID_INTERVAL ticks, and the rest hibernate,
+        only carried on towards their target every AI_FAR_INTERVAL ticks.
+        A monster which thinks after missing ticks moves as far as it
+        would have in up to AI_MID_INTERVAL of them. The most overdue
+        monsters think first. Near monsters always think, the others only
+        while the tick is within its AI time budget, and those left over
+        wait for the next tick, ahead of those which thought since '''
+
+    # the level of detail of a monster
+    NEAR, MID, FAR = 0, 1, 2
+
+    def __init__(self, budget=AI_TIME_BUDGET):
+
+        self.budget = budget
+
+        # ticks between the updates of each level
+        self.intervals = (1, AI_MID_INTERVAL, AI_FAR_INTERVAL)
+
+        # when the monsters' part of the tick started, and what was done in it
+        self.start = 0
+        self.counts = [0, 0, 0]
+        self.deferred = 0
+
+    def begin(self):
+        ''' starts the monsters' part of a tick '''
+
+        self.start = time.perf_counter()
+        self.counts = [0, 0, 0]
+        self.deferred = 0
+
+    def level(self, obj, player):
+        ''' returns the level of detail of a monster, dying ones are
+            always near so they finish dying '''
+
+        distance = (obj.pos_x - player.pos_x) ** 2 + (obj.pos_y - player.pos_y) ** 2
+        if obj.dead_state or distance <= AI_NEAR_RADIUS ** 2:
+            return self.NEAR
+        elif distance <= AI_MID_RADIUS ** 2:
+            return self.MID
+        return self.FAR
+
+    def over_budget(self):
+        ''' returns True once the tick has used its AI time '''
+
+        return self.budget != None and time.perf_counter() - self.start > self.budget
+
+    def due(self, level, elapsed):
+        ''' returns True if a monster of the level, last updated elapsed
+            ticks ago, is updated this tick '''
+
+        if elapsed < self.intervals[level]:
+            return False
+        if level != self.NEAR and self.over_budget():
+            self.deferred += 1
+            return False
+        self.counts[level] += 1
+        return True
+
+class Entity_Store():
+    ''' keeps the state of every monster in numpy arrays, one row per
+        monster, so a tick runs the Monster logic for all monsters as a
+        few array operations instead of python calls per monster. Each
+        live row has a Monster_View, which the drawing, hud and attack
+        code use like a Monster sprite. Dead rows are reused by new
+        monsters. Like the Monster functions, monsters never melee attack '''
+
+    # every array of the store and its type, one element per row
+    FIELDS = [  ('alive', bool), ('pos_x', float), ('pos_y', float),
+                ('target_x', float), ('target_y', float), ('has_target', bool),
+                ('direction', 'int8'), ('speed', 'int32'), ('health', 'int32'),
+                ('frame', 'int32'), ('timer_for_attack', 'int32'),
+                ('spell_state', bool), ('dead_state', bool), ('find_player_state', bool),
+                ('collide', bool), ('width', 'int32'), ('height', 'int32'),
+                ('image_action', 'int8'), ('image_frame', 'int32'), ('ai_tick', 'int64')  ]
+
+    # the actions an image can be taken from, in the order of self.images
+    MOVE_IMAGE, SPELL_IMAGE, DEAD_IMAGE = 0, 1, 2
+
+    def __init__(self, animation_bank, collision_grid, character='skeleton', capacity=64):
+
+        # the frames of the monsters' move, spell and dead actions
+        self.definition = animation_bank.define(self, character)
+        move, spell, dead = [self.definition.action(name) for name in [MOVE, SPELL, DEAD]]
+        self.images = (move.frames, spell.frames, dead.frames)
+        self.move_length = move.count
+        self.spell_length = spell.count
+        self.dead_length = dead.count
+        self.cooldown = spell.cooldown
+
+        # the step taken in each direction, by direction index
+        self.step_x = numpy.array([DIRECTION_VECTOR[direction][0] for direction in DIRECTIONS])
+        self.step_y = numpy.array([DIRECTION_VECTOR[direction][1] for direction in DIRECTIONS])
+
+        # blocked cells summed over every rectangle from the top-left of the
+        # map, so the blocked cells under any rect cost four lookups
+        self.collision_grid = collision_grid
+        cells = numpy.frombuffer(collision_grid.cells, dtype=numpy.uint8)
+        cells = cells.reshape(collision_grid.height, collision_grid.width)
+        self.blocked_sums = numpy.zeros((collision_grid.height + 1, collision_grid.width + 1), dtype=numpy.int32)
+        self.blocked_sums[1:, 1:] = cells.cumsum(0).cumsum(1)
+
+        # rows in use are below size, dead rows below it are free
+        for name, dtype in self.FIELDS:
+            setattr(self, name, numpy.zeros(capacity, dtype=dtype))
+        self.views = [None] * capacity
+        self.free = []
+        self.size = 0
+        self.count = 0
+
+        # the route and leg cells of every row, as Monster keeps them
+        self.routes = [None] * capacity
+        self.steps = [None] * capacity
+
+        # wander targets come from the game's random state, so a seeded game repeats
+        self.rng = numpy.random.default_rng(random.getrandbits(64))
+
+    def add(self, pos_x, pos_y, speed, tick=0):
+        ''' adds a monster standing at the world position facing down on
+            the tick, and returns its view '''
+
+        if self.free:
+            index = self.free.pop()
+        else:
+            if self.size == len(self.alive):
+                self.grow()
+            index = self.size
+            self.size += 1
+
+        for name, dtype in self.FIELDS:
+            getattr(self, name)[index] = 0
+        self.alive[index] = True
+        self.pos_x[index] = pos_x
+        self.pos_y[index] = pos_y
+        self.direction[index] = DOWN
+        self.speed[index] = speed
+        self.health[index] = 100
+        self.ai_tick[index] = tick - 1
+
+        # the rect keeps the size of the first frame, as top-left anchors do
+        self.width[index], self.height[index] = self.definition.size
+
+        self.routes[index] = []
+        self.steps[index] = []
+
+        view = Monster_View(self, index)
+        self.views[index] = view
+        self.count += 1
+        return view
+
+    def grow(self):
+        ''' doubles the number of rows '''
+
+        for name, dtype in self.FIELDS:
+            array_ = getattr(self, name)
+            setattr(self, name, numpy.concatenate([array_, numpy.zeros(len(array_), dtype=dtype)]))
+        self.routes += [None] * len(self.views)
+        self.steps += [None] * len(self.views)
+        self.views += [None] * len(self.views)
+
+    def remove(self, index):
+        ''' frees the row of a dead monster '''
+
+        if not self.alive[index]:
+            return
+        self.alive[index] = False
+        self.views[index] = None
+        self.free.append(index)
+        self.count -= 1
+
+    def rects(self):
+        ''' returns the x, y, width and height of the world rect of every
+            row, rounded the way a Rect rounds its co-ordinates '''
+
+        size = self.size
+        return self.rounded(self.pos_x[:size]), self.rounded(self.pos_y[:size]), self.width[:size], self.height[:size]
+
+    def rounded(self, values):
+        ''' returns the co-ordinates rounded half away from zero, as a Rect does '''
+
+        return numpy.copysign(numpy.floor(numpy.abs(values) + 0.5), values).astype(numpy.int64)
+
+    def colliding(self, rect, rect_x, rect_y, width, height):
+        ''' returns which of the rects overlap the pygame rect '''
+
+        return ((rect_x < rect.right) & (rect.left < rect_x + width) &
+                (rect_y < rect.bottom) & (rect.top < rect_y + height) &
+                (width > 0) & (height > 0) & (rect.width > 0) & (rect.height > 0))
+
+    def blocked(self, rect_x, rect_y, width, height):
+        ''' returns which of the rects overlap a blocked cell, the same
+            as Collision_Grid.is_blocked on each rect '''
+
+        grid = self.collision_grid
+        first_col = numpy.maximum(0, rect_x // grid.tilewidth)
+        last_col = numpy.minimum(grid.width - 1, (rect_x + width - 1) // grid.tilewidth)
+        first_row = numpy.maximum(0, rect_y // grid.tileheight)
+        last_row = numpy.minimum(grid.height - 1, (rect_y + height - 1) // grid.tileheight)
+        inside = (first_col <= last_col) & (first_row <= last_row)
+
+        # rects off the map have their ranges clamped, they are masked out anyway
+        first_col = numpy.minimum(first_col, grid.width - 1)
+        last_col = numpy.maximum(last_col, 0) + 1
+        first_row = numpy.minimum(first_row, grid.height - 1)
+        last_row = numpy.maximum(last_row, 0) + 1
+        sums = self.blocked_sums
+        blocked = (sums[last_row, last_col] - sums[first_row, last_col]
+                   - sums[last_row, first_col] + sums[first_row, first_col])
+        return inside & (blocked > 0)
+
+    def step(self, player, targets, flow_field, path_graph, scheduler, tick):
+        ''' runs one tick of every monster the scheduler has due: finding
+            the player, choosing a target, turning, colliding with the map
+            and the targets, and changing frame, as the Monster functions
+            do one at a time. Hibernating monsters are only carried on '''
+
+        size = self.size
+        pos_x, pos_y = self.pos_x[:size], self.pos_y[:size]
+        target_x, target_y = self.target_x[:size], self.target_y[:size]
+        has_target = self.has_target[:size]
+        direction = self.direction[:size]
+        frame = self.frame[:size]
+        timer = self.timer_for_attack[:size]
+        spell_state, dead_state = self.spell_state[:size], self.dead_state[:size]
+        image_action, image_frame = self.image_action[:size], self.image_frame[:size]
+
+        # the level of detail of every row and the rows due this tick, as AI_Scheduler does
+        distance = (pos_x - player.pos_x) ** 2 + (pos_y - player.pos_y) ** 2
+        levels = numpy.select([dead_state | (distance <= AI_NEAR_RADIUS ** 2), distance <= AI_MID_RADIUS ** 2],
+                              [scheduler.NEAR, scheduler.MID], scheduler.FAR)
+        elapsed = tick - self.ai_tick[:size]
+        due = self.alive[:size] & (elapsed >= numpy.array(scheduler.intervals)[levels])
+
+        # monsters close enough to see the player, measured as query_radius does
+        rect_x, rect_y, width, height = self.rects()
+        area = pygame.Rect(player.pos_x - AGGRO_RADIUS, player.pos_y - AGGRO_RADIUS,
+                           2 * AGGRO_RADIUS + 1, 2 * AGGRO_RADIUS + 1)
+        closest_x = numpy.minimum(numpy.maximum(player.pos_x, rect_x), rect_x + width - 1)
+        closest_y = numpy.minimum(numpy.maximum(player.pos_y, rect_y), rect_y + height - 1)
+        near = (self.colliding(area, rect_x, rect_y, width, height) &
+                ((closest_x - player.pos_x) ** 2 + (closest_y - player.pos_y) ** 2 <= AGGRO_RADIUS ** 2))
+
+        # the most overdue rows go first, those away from the player wait for
+        # the next tick once the AI time is used up, as AI_Scheduler.due does.
+        # Wandering rows choose their target as they go, the rest together below
+        wandering = (levels != scheduler.FAR) & ~spell_state & ~near & ~has_target
+        rows = numpy.flatnonzero(due)
+        alive = numpy.zeros(size, dtype=bool)
+        for index in rows[numpy.argsort(self.ai_tick[rows], kind='stable')].tolist():
+            level = levels[index]
+            if level != scheduler.NEAR and scheduler.over_budget():
+                scheduler.deferred += 1
+                continue
+            scheduler.counts[level] += 1
+            alive[index] = True
+            if wandering[index]:
+                self.wander(index, path_graph)
+        self.ai_tick[:size][alive] = tick
+        self.extrapolate(alive & (levels == scheduler.FAR), elapsed)
+
+        # the rest think, those which missed ticks move as far as they would have in a few of them
+        alive &= levels != scheduler.FAR
+        speed = numpy.where(alive, self.speed[:size] * numpy.minimum(elapsed, AI_MID_INTERVAL), 0)
+        self.find_player_state[:size][alive] = near[alive]
+
+        # casting monsters stand still, those near the player chase it
+        has_target[alive & spell_state] = False
+        chase = numpy.flatnonzero(alive & ~spell_state & near)
+        if len(chase):
+            target_x[chase], target_y[chase] = self.flow_targets(flow_field, pos_x[chase], pos_y[chase], player)
+        has_target[chase] = True
+        for index in chase:
+            del self.routes[index][:]
+            del self.steps[index][:]
+
+        # turn towards the target, the same tests in the same order as set_direction
+        position_margin = 5
+        right = pos_x < target_x - position_margin
+        left = pos_x > target_x + position_margin
+        down = pos_y < target_y - position_margin
+        up = pos_y > target_y + position_margin
+        turn = numpy.select([right & down, left & down, right & up, left & up, left, right, down, up],
+                            [DOWN_RIGHT, DOWN_LEFT, UP_RIGHT, UP_LEFT, LEFT, RIGHT, DOWN, UP], -1)
+        turning = alive & has_target & (turn >= 0)
+        direction[turning] = turn[turning]
+        has_target[alive & has_target & (turn < 0)] = False
+
+        # the rect hits the map if it overlaps a blocked cell anywhere along its next move
+        step_x, step_y = self.step_x[direction], self.step_y[direction]
+        hit_map = numpy.zeros(size, dtype=bool)
+        for step in range(int(speed.max(initial=0)) + 1):
+            moving = alive & (step <= speed)
+            hit_map |= moving & self.blocked(rect_x + step_x * step, rect_y + step_y * step, width, height)
+
+        # monsters cast spells at the targets they walk into
+        next_x, next_y = rect_x + step_x * speed, rect_y + step_y * speed
+        hit_object = numpy.zeros(size, dtype=bool)
+        for sprite in targets:
+            hit_object |= self.colliding(sprite.rect, next_x, next_y, width, height)
+        spell_state[alive] = hit_object[alive]
+        self.collide[:size] = alive & (hit_map | hit_object)
+        has_target[self.collide[:size]] = False
+
+        # change frame, the branches of set_frame from the frame each started at
+        timer[alive & (timer > 0)] -= 1
+        start_frame = frame.copy()
+
+        spell = alive & spell_state & (timer == 0)
+        casting = spell & (start_frame < self.spell_length - 1)
+        image_action[casting] = self.SPELL_IMAGE
+        image_frame[casting] = start_frame[casting]
+        frame[casting] += 1
+
+        # the spell is over, wait before the next and show the first move frame
+        finished = spell & ~casting
+        timer[finished] = self.cooldown
+        spell_state[finished] = False
+        image_action[finished] = self.MOVE_IMAGE
+        image_frame[finished] = 0
+        frame[finished] = has_target[finished]
+
+        dead = alive & ~spell & dead_state
+        dying = dead & (start_frame < self.dead_length - 1)
+        image_action[dying] = self.DEAD_IMAGE
+        image_frame[dying] = start_frame[dying]
+        frame[dying] += 1
+
+        stopped = alive & ~spell & ~dead_state & ~has_target
+        image_action[stopped] = self.MOVE_IMAGE
+        image_frame[stopped] = 0
+        frame[stopped] = 0
+
+        walking = alive & ~spell & ~dead_state & has_target
+        image_action[walking] = self.MOVE_IMAGE
+        image_frame[walking] = start_frame[walking]
+        frame[walking] = numpy.where(start_frame[walking] == self.move_length - 1, 0, start_frame[walking] + 1)
+        pos_x[walking] += step_x[walking] * speed[walking]
+        pos_y[walking] += step_y[walking] * speed[walking]
+
+        # the dying animation is over
+        for index in numpy.flatnonzero(dead & ~dying):
+            self.remove(index)
+
+    def wander(self, index, path_graph):
+        ''' gives the row the next cell of its route, and a new route to a
+            random spot once it finished the last, as Monster.set_target_pos does '''
+
+        routes, steps = self.routes, self.steps
+        pos_x, pos_y = self.pos_x[index], self.pos_y[index]
+
+        # the spot is rolled x then y, like the random module rolls it for sprites
+        if len(routes[index]) == 0 and len(steps[index]) == 0:
+            low = numpy.array([int(pos_x), int(pos_y)]) - WANDER_DISTANCE
+            goal = tuple(self.rng.integers(low, low + 2 * WANDER_DISTANCE + 1).tolist())
+            routes[index] = path_graph.find_path(pos_x, pos_y, goal[0], goal[1]) or []
+
+            # off the path graph, walk straight there
+            if len(routes[index]) == 0:
+                self.target_x[index], self.target_y[index] = goal
+                self.has_target[index] = True
+                return
+
+        target = path_graph.next_target(pos_x, pos_y, routes[index], steps[index])
+        if target != (None, None):
+            self.target_x[index], self.target_y[index] = target
+            self.has_target[index] = True
+
+    def extrapolate(self, rows, elapsed):
+        ''' carries the hibernating rows on towards their targets, as
+            extrapolate does one at a time '''
+
+        size = self.size
+        moving = numpy.flatnonzero(rows & self.has_target[:size] & ~self.spell_state[:size] & ~self.dead_state[:size])
+        if len(moving) == 0:
+            return
+
+        pos_x, pos_y = self.pos_x[moving], self.pos_y[moving]
+        direction = self.direction[moving]
+        step_x, step_y = self.step_x[direction], self.step_y[direction]
+        distance = self.speed[moving] * numpy.minimum(elapsed[moving], AI_FAR_INTERVAL)
+        move_x = numpy.minimum(distance, numpy.abs(self.target_x[moving] - pos_x))
+        move_y = numpy.minimum(distance, numpy.abs(self.target_y[moving] - pos_y))
+
+        # only rows with a blocked cell in the box they sweep can hit a wall on the way
+        reach = numpy.ceil(numpy.maximum(numpy.where(step_x != 0, move_x, 0),
+                                          numpy.where(step_y != 0, move_y, 0))).astype(numpy.int64)
+        rect_x, rect_y = self.rounded(pos_x), self.rounded(pos_y)
+        width, height = self.width[moving], self.height[moving]
+        swept = self.blocked(rect_x + numpy.minimum(step_x, 0) * reach, rect_y + numpy.minimum(step_y, 0) * reach,
+                             width + numpy.abs(step_x) * reach, height + numpy.abs(step_y) * reach)
+        for index in numpy.flatnonzero(swept):
+            rect = pygame.Rect(int(rect_x[index]), int(rect_y[index]), int(width[index]), int(height[index]))
+            hit = self.collision_grid.first_hit_along(rect, int(direction[index]), int(reach[index]))
+            if hit != None:
+                move_x[index] = min(move_x[index], hit)
+                move_y[index] = min(move_y[index], hit)
+                self.has_target[moving[index]] = False
+
+        next_x = pos_x + step_x * move_x
+        next_y = pos_y + step_y * move_y
+
+        # those which would still end up in a wall stop where they are
+        blocked = self.blocked(self.rounded(next_x), self.rounded(next_y), self.width[moving], self.height[moving])
+        self.pos_x[moving] = numpy.where(blocked, pos_x, next_x)
+        self.pos_y[moving] = numpy.where(blocked, pos_y, next_y)
+        self.has_target[moving[blocked]] = False
+
+    def flow_targets(self, flow_field, pos_x, pos_y, player):
+        ''' returns the targets of the positions from the flow field, as
+            Flow_Field.next_target does one at a time '''
+
+        grid = flow_field.collision_grid
+        col = numpy.floor_divide(pos_x + grid.tilewidth // 2, grid.tilewidth).astype(numpy.int64)
+        row = numpy.floor_divide(pos_y + grid.tileheight // 2, grid.tileheight).astype(numpy.int64)
+        on_map = (col >= 0) & (col < grid.width) & (row >= 0) & (row < grid.height)
+        cell = numpy.where(on_map, row * grid.width + col, 0)
+
+        # the field is read in place, without copying it
+        searched = numpy.frombuffer(flow_field.searched, dtype=numpy.uint32)[cell]
+        direction = numpy.frombuffer(flow_field.directions, dtype=numpy.uint8)[cell]
+        follow = on_map & (searched == flow_field.search) & (cell != flow_field.goal)
+
+        # cells off the field lead to the player, their direction is never used
+        direction = numpy.where(follow, direction, UP)
+        target_x = numpy.where(follow, (col + self.step_x[direction]) * grid.tilewidth, player.pos_x)
+        target_y = numpy.where(follow, (row + self.step_y[direction]) * grid.tileheight, player.pos_y)
+        return target_x, target_y
+
+    def query_rect(self, rect):
+        ''' returns the views of the monsters overlapping the rect, in row order '''
+
+        rect_x, rect_y, width, height = self.rects()
+        found = self.colliding(rect, rect_x, rect_y, width, height) & self.alive[:self.size]
+        return [self.views[index] for index in numpy.flatnonzero(found)]
+
+    def sprites(self):
+        ''' returns the views of every live monster '''
+
+        return [view for view in self.views[:self.size] if view != None]
+
+    def __iter__(self):
+        return iter(self.sprites())
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, obj):
+        return type(obj) == Monster_View and obj.store is self and self.views[obj.index] is obj
+
+class Monster_View():
+    ''' one monster of an Entity_Store, with the attributes of a Monster
+        the drawing, hud and attack code use. Setting one writes its row '''
+
+    __slots__ = ['store', 'index']
+
+    # every stored monster is a skeleton
+    name = 'jerry the skeleton'
+    level = 10
+
+    def __init__(self, store, index):
+        self.store = store
+        self.index = index
+
+    def alive(self):
+        return self.store.views[self.index] is self
+
+    def kill(self):
+        if self.alive():
+            self.store.remove(self.index)
+
+    @property
+    def pos_x(self):
+        return float(self.store.pos_x[self.index])
+
+    @property
+    def pos_y(self):
+        return float(self.store.pos_y[self.index])
+
+    @property
+    def direction(self):
+        return int(self.store.direction[self.index])
+
+    @property
+    def rect(self):
+        store, index = self.store, self.index
+        rect = pygame.Rect(0, 0, int(store.width[index]), int(store.height[index]))
+        rect.x, rect.y = float(store.pos_x[index]), float(store.pos_y[index])
+        return rect
+
+    @property
+    def image(self):
+        store, index = self.store, self.index
+        return store.images[store.image_action[index]][store.direction[index]][store.image_frame[index]]
+
+    @property
+    def health(self):
+        return int(self.store.health[self.index])
+
+    @health.setter
+    def health(self, value):
+        self.store.health[self.index] = value
+
+    @property
+    def frame(self):
+        return int(self.store.frame[self.index])
+
+    @frame.setter
+    def frame(self, value):
+        self.store.frame[self.index] = value
+
+    @property
+    def dead_state(self):
+        return bool(self.store.dead_state[self.index])
+
+    @dead_state.setter
+    def dead_state(self, value):
+        self.store.dead_state[self.index] = value
+
 def create_map(file):
-        ''' builds the tile information into all_layers '''
-        
-        # open and load the file
-        mapfile = open(file).read()
-        mapdict = json.loads(mapfile)
-
-        # open all used images JSON
-        tilesets = mapdict["tilesets"]
-        imageset = []
-
-        # load tiles from each png file
-        for images in tilesets:
-            image_source = images["source"]
-            image_json = open(image_source).read()
-            image_ele = json.loads(image_json)
-            imageset.append(image_ele)
+        ''' builds the tile information into all_layers. The map is read
+            from its compiled cache, which is rebuilt when it is missing
+            or the map or one of its tilesets changed '''
+
+        cache_file = os.path.splitext(file)[0] + MAP_CACHE_EXTENSION
+        compiled = load_compiled_map(cache_file)
+
+        if compiled == None:
+            buffer = compile_map(file)
+
+            # the cache only saves time, the map still loads without it
+            try:
+                temp_file = cache_file + '.tmp'
+                with open(temp_file, 'wb') as cache:
+                    cache.write(buffer)
+                os.replace(temp_file, cache_file)
+            except OSError:
+                pass
+            compiled = read_compiled_map(buffer)
+
+        header, data = compiled
+
+        # all used tilesets, ordered by their first gid
+        tilesets = [Tileset(tileset) for tileset in header["tilesets"]]
+        tilesets.sort(key=lambda tileset: tileset.firstgid)
         
-        # declare JSON headers
-        layers = mapdict["layers"]
-        height = mapdict["height"]
-        width = mapdict["width"]
-        all_tiles_from_sets = []
-
-        # create tiles from all images
-        for image in imageset:
-                tileset_image = pygame.image.load(image["image"]).convert_alpha()
-                imageheight = image["imageheight"]
-                imagewidth = image["imagewidth"]
-                tilewidth = image["tilewidth"]
-                tileheight = image["tileheight"]
-                for y in range(0, imageheight, tileheight):
-                        for x in range (0, imagewidth, tilewidth):
-                            tile = pygame.Surface((tilewidth, tileheight))
-                            tile.blit(tileset_image, (0,0), (x, y, tilewidth, tileheight))
-                            tile.set_colorkey(BLACK)
-                            all_tiles_from_sets.append(tile)
+        # declare map headers
+        height = header["height"]
+        width = header["width"]
+        tilewidth = header["tilewidth"]
+        tileheight = header["tileheight"]
 
         # declare dictionaries to hold layer and object data
         all_layers = {}        
-        all_objects = {}
-
-        # create different layers and collison data
-        for layer in layers:
+        all_objects = header["objects"]
+
+        # every collision layer was compiled into one grid
+        collision_grid = Collision_Grid(width, height, tilewidth, tileheight)
+        offset = header["collision_offset"]
+        collision_grid.cells = data[offset:offset + width * height]
+
+        # the portal graph was built with the map, the regions of its cells follow the collision cells
+        graph = header["path_graph"]
+        offset = graph["regions_offset"]
+        regions = data[offset:offset + 4 * width * height].cast('I')
+        path_graph = Path_Graph(collision_grid, regions, graph["cluster_size"], graph["nodes"], graph["edges"])
+
+        # create the different layers, each reads its gids from the cache
+        for layer in header["layers"]:
+            offset = layer["offset"]
+            size = layer["count"] * struct.calcsize(layer["typecode"])
+            layer_data = data[offset:offset + size].cast(layer["typecode"])
+
+            current_layer = Chunked_Layer(layer_data, layer["width"], layer["height"],
+                                          tilewidth, tileheight, tilesets, layer["above"])
+            all_layers[layer["name"]] = [ current_layer, layer["collision"] ]
             
-            # set the layer of tiles as a sprite group
-            current_layer = pygame.sprite.Group()
-
-            # see if the current layer is an object layer
-            if layer["name"][-7:] == "objects":
-                name = layer["name"]
-                objects = layer["objects"]
-                all_objects[name] = objects
-                
-            # the layer is a tile layer
-            else:
-                data = layer["data"]
-                name = layer["name"]
-                layerheight = layer["height"]
-                layerwidth = layer["width"]
-                properties = layer["properties"]
-                try:
-                    collision = properties["collision"]
-                except KeyError:
-                    collision = 0
-                    
-                data_pos = 0
-
-                for y in range (0, layerheight):
-                    for x in range (0, layerwidth):
-                        gid = data[data_pos]
-                        if gid > 0:
-                            tile = Tile(all_tiles_from_sets[gid - 1])
-                            # set the player at [0,0] on the map
-                            tilex = x * tilewidth + SCREENWIDTH/2
-                            tiley = y * tileheight + SCREENHEIGHT/2
-                            tile.rect.topleft = (tilex, tiley)
-                            current_layer.add(tile)
-                        data_pos += 1
-
-            all_layers[name] = [ current_layer, collision ]
-            
-        return all_layers, all_objects
+        return all_layers, all_objects, collision_grid, path_graph
+
+def compile_map(file):
+    ''' compiles a JSON map and its tilesets into the binary map cache
+        and returns it as bytes. The cache is a JSON header with the map
+        size, tilesets, objects, layer offsets and path graph, followed by
+        every layer's gids as packed uint16 / uint32, one collision byte
+        per cell and the path finding region of every cell as uint32 '''
+
+    mapdict = json.loads(open(file).read())
+
+    # files the compiled map depends on
+    sources = [file]
+
+    # external tilesets are read now so loading the cache needs no JSON files
+    tilesets = []
+    for tileset in mapdict["tilesets"]:
+        if "source" in tileset:
+            sources.append(tileset["source"])
+            tileset_dict = json.loads(open(tileset["source"]).read())
+        else:
+            tileset_dict = dict(tileset)
+        tileset_dict["firstgid"] = tileset["firstgid"]
+        tilesets.append(tileset_dict)
+
+    width, height = mapdict["width"], mapdict["height"]
+    tilewidth, tileheight = mapdict["tilewidth"], mapdict["tileheight"]
+    collision_grid = Collision_Grid(width, height, tilewidth, tileheight)
+
+    layers = []
+    objects = {}
+    blobs = []
+    offset = 0
+
+    for layer in mapdict["layers"]:
+
+        # see if the current layer is an object layer
+        if layer["name"][-7:] == "objects":
+            objects[layer["name"]] = layer["objects"]
+            continue
+
+        # the layer is a tile layer
+        data = layer["data"]
+        try:
+            collision = layer["properties"]["collision"]
+        except KeyError:
+            collision = 0
+        if collision:
+            collision_grid.add_layer(data)
+
+        # layers drawn over the characters have the custom property "above"
+        try:
+            above = bool(layer["properties"]["above"])
+        except KeyError:
+            above = False
+
+        # gids fit in 16 bits unless a tileset or flip flag goes above
+        typecode = 'H' if max(data, default=0) < 65536 else 'I'
+        packed = array.array(typecode, data).tobytes()
+
+        # keep every block 4 byte aligned so it can be cast in place
+        packed += bytes(-len(packed) % 4)
+        layers.append({ "name": layer["name"], "width": layer["width"], "height": layer["height"],
+                        "collision": collision, "above": above, "typecode": typecode, "offset": offset,
+                        "count": len(data) })
+        blobs.append(packed)
+        offset += len(packed)
+
+    blobs.append(bytes(collision_grid.cells) + bytes(-len(collision_grid.cells) % 4))
+    regions_offset = offset + len(blobs[-1])
+
+    regions, nodes, edges = build_path_graph(collision_grid)
+    blobs.append(regions.tobytes())
+
+    header = {  "byteorder": sys.byteorder,
+                "sources": [source_signature(source) for source in sources],
+                "width": width, "height": height,
+                "tilewidth": tilewidth, "tileheight": tileheight,
+                "tilesets": tilesets, "layers": layers, "objects": objects,
+                "collision_offset": offset,
+                "path_graph": { "cluster_size": PATH_CLUSTER_SIZE, "nodes": nodes, "edges": edges,
+                                "regions_offset": regions_offset }  }
+
+    header_bytes = json.dumps(header).encode()
+    prefix_size = struct.calcsize('<4sHI')
+    header_bytes += b' ' * (-(prefix_size + len(header_bytes)) % 4)
+
+    return (struct.pack('<4sHI', MAP_CACHE_MAGIC, MAP_CACHE_VERSION, len(header_bytes))
+            + header_bytes + b''.join(blobs))
+
+def path_clearance(collision_grid, clearance=PATH_CLEARANCE):
+    ''' returns one byte per cell, 1 if every cell within clearance cells
+        of it is on the map and free '''
+
+    width, height, cells = collision_grid.width, collision_grid.height, collision_grid.cells
+
+    # blocked cells summed over every rectangle from the top-left of the map
+    sums = array.array('i', bytes(4 * (width + 1) * (height + 1)))
+    for row in range(height):
+        run = 0
+        above, below = row * (width + 1), (row + 1) * (width + 1)
+        for col in range(width):
+            run += cells[row * width + col]
+            sums[below + col + 1] = sums[above + col + 1] + run
+
+    clear = bytearray(width * height)
+    for row in range(clearance, height - clearance):
+        top, bottom = (row - clearance) * (width + 1), (row + clearance + 1) * (width + 1)
+        for col in range(clearance, width - clearance):
+            left, right = col - clearance, col + clearance + 1
+            if sums[bottom + right] - sums[top + right] - sums[bottom + left] + sums[top + left] == 0:
+                clear[row * width + col] = 1
+    return clear
+
+def clear_neighbours(clear, width, cell, bounds):
+    ''' yields every clear cell a step away from the cell and inside the
+        bounds, the first and last column and row. Diagonal steps can't
+        cut the corner of a cell which isn't clear '''
+
+    first_col, last_col, first_row, last_row = bounds
+    col, row = cell % width, cell // width
+    for direction in DIRECTIONS:
+        step_x, step_y = DIRECTION_VECTOR[direction]
+        next_col, next_row = col + step_x, row + step_y
+        if not (first_col <= next_col <= last_col and first_row <= next_row <= last_row):
+            continue
+        next_cell = next_row * width + next_col
+        if not clear[next_cell]:
+            continue
+        if step_x and step_y and not (clear[row * width + next_col] and clear[next_row * width + col]):
+            continue
+        yield next_cell
+
+def build_path_graph(collision_grid, cluster_size=PATH_CLUSTER_SIZE):
+    ''' returns the region of every cell of the map, the cell of every
+        portal between neighbouring clusters and the edges of the portal
+        graph as a flat list of node, node and cost. A region is a part
+        of a cluster whose clear cells join up inside it, numbered from 1,
+        and cells which aren't clear are in region 0. Each entrance, a
+        run of clear cells facing each other across a cluster border, gets
+        a portal pair at its middle, or at both ends when it is wide. The
+        portals of a region are joined by the length of the way between
+        them inside the cluster '''
+
+    width, height = collision_grid.width, collision_grid.height
+    clear = path_clearance(collision_grid)
+    regions = array.array('I', bytes(4 * width * height))
+
+    nodes = []
+    node_of = {}
+    edges = []
+
+    # the portals of each cluster, by its first column and row
+    cluster_portals = {}
+
+    def node(cell):
+        if cell not in node_of:
+            node_of[cell] = len(nodes)
+            nodes.append(cell)
+            key = ((cell % width) // cluster_size * cluster_size, (cell // width) // cluster_size * cluster_size)
+            cluster_portals.setdefault(key, []).append(node_of[cell])
+        return node_of[cell]
+
+    def add_entrances(pairs):
+        run = []
+        for pair in pairs + [None]:
+            if pair != None and clear[pair[0]] and clear[pair[1]]:
+                run.append(pair)
+                continue
+            if run:
+                ends = [run[len(run) // 2]] if len(run) < PATH_ENTRANCE_SPLIT else [run[0], run[-1]]
+                for cell_a, cell_b in ends:
+                    edges.extend([node(cell_a), node(cell_b), 1])
+                run = []
+
+    # clusters are visited row by row, so the portals on their left and top
+    # border are already made by the time their right and bottom ones are
+    region_count = 0
+    for first_row in range(0, height, cluster_size):
+        for first_col in range(0, width, cluster_size):
+            last_col = min(width, first_col + cluster_size) - 1
+            last_row = min(height, first_row + cluster_size) - 1
+            bounds = (first_col, last_col, first_row, last_row)
+
+            if last_col + 1 < width:
+                add_entrances([(row * width + last_col, row * width + last_col + 1)
+                               for row in range(first_row, last_row + 1)])
+            if last_row + 1 < height:
+                add_entrances([(last_row * width + col, (last_row + 1) * width + col)
+                               for col in range(first_col, last_col + 1)])
+
+            # the steps from every clear cell of the cluster, worked out once for all the searches
+            neighbours = {}
+            for row in range(first_row, last_row + 1):
+                for cell in range(row * width + first_col, row * width + last_col + 1):
+                    if clear[cell]:
+                        neighbours[cell] = list(clear_neighbours(clear, width, cell, bounds))
+
+            # flood the clear cells of the cluster into regions
+            for cell in neighbours:
+                if regions[cell] == 0:
+                    region_count += 1
+                    regions[cell] = region_count
+                    frontier = [cell]
+                    while frontier:
+                        next_frontier = []
+                        for flooded in frontier:
+                            for next_cell in neighbours[flooded]:
+                                if regions[next_cell] == 0:
+                                    regions[next_cell] = region_count
+                                    next_frontier.append(next_cell)
+                        frontier = next_frontier
+
+            # the length of the way between every two portals of the cluster, inside it
+            portals = cluster_portals.get((first_col, first_row), [])
+            for portal in portals:
+                steps = {nodes[portal]: 0}
+                frontier = [nodes[portal]]
+                while frontier:
+                    next_frontier = []
+                    for cell in frontier:
+                        for next_cell in neighbours[cell]:
+                            if next_cell not in steps:
+                                steps[next_cell] = steps[cell] + 1
+                                next_frontier.append(next_cell)
+                    frontier = next_frontier
+                for other in portals:
+                    if other > portal and nodes[other] in steps:
+                        edges.extend([portal, other, steps[nodes[other]]])
+
+    return regions, nodes, edges
+
+def read_compiled_map(buffer):
+    ''' returns the header and a view of the data of a compiled map,
+        or None if the buffer is not a compiled map of this version '''
+
+    prefix_size = struct.calcsize('<4sHI')
+    if len(buffer) < prefix_size:
+        return None
+
+    magic, version, header_size = struct.unpack_from('<4sHI', buffer)
+    if magic != MAP_CACHE_MAGIC or version != MAP_CACHE_VERSION:
+        return None
+
+    header = json.loads(bytes(buffer[prefix_size:prefix_size + header_size]))
+    if header["byteorder"] != sys.byteorder:
+        return None
+
+    return header, memoryview(buffer)[prefix_size + header_size:]
+
+def load_compiled_map(cache_file):
+    ''' memory-maps a compiled map, returns None if there is none
+        or the files it was compiled from have changed since '''
+
+    try:
+        with open(cache_file, 'rb') as cache:
+            buffer = mmap.mmap(cache.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    compiled = read_compiled_map(buffer)
+    if compiled == None:
+        return None
+
+    for signature in compiled[0]["sources"]:
+        if source_changed(signature):
+            return None
+
+    return compiled
+
+def source_signature(path):
+    ''' returns what is needed to tell if a file changed later '''
+
+    stat = os.stat(path)
+    return {    "path": path, "mtime": stat.st_mtime_ns, "size": stat.st_size,
+                "sha1": hashlib.sha1(open(path, 'rb').read()).hexdigest()  }
+
+def source_changed(signature):
+    ''' checks a file against its signature. Files with a new mtime are
+        only counted as changed if their contents changed as well '''
+
+    try:
+        stat = os.stat(signature["path"])
+    except OSError:
+        return True
+
+    if stat.st_mtime_ns == signature["mtime"] and stat.st_size == signature["size"]:
+        return False
+
+    return hashlib.sha1(open(signature["path"], 'rb').read()).hexdigest() != signature["sha1"]
 
 def create_sprite_frames(path_extenstion, file_name, key):
     ''' takes the folder of images, and returns a list of matched ones '''
 
-    # detect the current working directory
-    path = os.getcwd()
+    # return a list of sorted images
+    img_lst = []
+    
+    for file in sprite_frame_files(path_extenstion, file_name):
+        image = image_parser(file, key)
+        img_lst.append(image)
+        
+    return img_lst
+
+def sprite_frame_files(path_extenstion, file_name):
+    ''' returns the paths of the frames in the folder, in frame order '''
 
-    # if a folder is required in the current directory
-    path += path_extenstion
+    # the folder is inside the current working directory
+    path = os.path.join(os.getcwd(), path_extenstion)
 
     # find all files that match the specification
     file_lst = []
 
-    # return a list of sorted images
-    img_lst = []
-
     # read the entries
     with os.scandir(path) as listOfEntries:  
         for entry in listOfEntries:
@@ -425,264 +2858,195 @@ def create_sprite_frames(path_extenstion, file_name, key):
                 if file_name in entry.name:
                     file_lst.append(entry.name)
     
-    sort_lst(file_lst)
-    
-    for file in file_lst:
-        image = image_parser(path + "\\" + file, key)
-        img_lst.append(image)
-        
+    file_lst.sort(key=frame_index)
+    return [os.path.join(path, file) for file in file_lst]
+
+def decode_animation(anim):
+    ''' reads the images of an animation without converting them, so it
+        can run on a loader thread. Returns its frames or its sprite sheet '''
+
+    if "sheet" in anim:
+        return [pygame.image.load(anim["sheet"])]
+    return [pygame.image.load(file) for file in sprite_frame_files(anim["directory"], anim["prefix"])]
+
+def convert_animation(anim, images):
+    ''' converts the images decode_animation read, on the main thread,
+        and returns the frames of the animation '''
+
+    img_lst = [convert_image(image, tuple(anim["colorkey"])) for image in images]
+    if "sheet" in anim:
+        return cut_sheet(anim, img_lst[0])
     return img_lst
 
-def set_attack_timer(character):
-    ''' if the player attacked, decrement the attack wait timer
-        otherwise, set the timer and change the attack state '''
+def frame_index(file_name):
+    ''' returns the frame number made by the digits in a file name '''
 
-    if character.attack_state and character.timer_for_attack == 0:
-        
-        # 15 cycles before the character can attack again
-        character.timer_for_attack = 15
-        character.frame = 0
+    return int(''.join(letter for letter in file_name if letter.isdigit()))
 
-        # the character is not attacking
-        character.attack_state = False
+def slice_sheet(anim):
+    ''' cuts the frames of an animation out of its sprite sheet
+        as subsurfaces, row by row '''
 
-    elif character.spell_state and character.timer_for_attack == 0:
-        
-        # 15 cycles before the character can attack again
-        character.timer_for_attack = 15
-        character.frame = 0
+    return cut_sheet(anim, image_parser(anim["sheet"], tuple(anim["colorkey"])))
 
-        # the character is not attacking
-        character.spell_state = False
+def cut_sheet(anim, sheet):
+    ''' cuts the frames of an animation out of its converted sprite
+        sheet as subsurfaces, row by row '''
 
-def adjust_for_player_movement(obj, player):
-    ''' moves all objects in the sprite to keep them still relative
-        to the player. direction is determined by the user '''
+    width, height = anim["frame_width"], anim["frame_height"]
 
-    move_object(obj, OPPOSITE_DIRECTION[player.direction])
+    img_lst = []
+    for row in range(anim["first_row"], anim["first_row"] + anim["rows"]):
+        for col in range(anim["first_col"], anim["first_col"] + anim["cols"]):
+            img_lst.append(sheet.subsurface((col * width, row * height, width, height)))
 
-def set_damage_state(character):
-    ''' determines whether the character can deal damage '''
+    return img_lst
+
+def load_atlas(manifest_file):
+    ''' loads the packed atlas image once and returns the frame table of
+        every animation in it as subsurfaces, keyed by animation name '''
+
+    manifest = json.loads(open(manifest_file).read())
+    return cut_atlas(manifest, pygame.image.load(manifest["image"]))
+
+def cut_atlas(manifest, image):
+    ''' converts a decoded atlas image, on the main thread, and returns
+        the frame table of every animation of the manifest in it '''
+
+    atlas = image.convert()
+
+    animations = {}
+    for name, anim in manifest["animations"].items():
+        cols = anim["cols"]
+        img_lst = []
+        for frame_rect in anim["frames"]:
+            image = atlas.subsurface(frame_rect)
+            image.set_colorkey(tuple(anim["colorkey"]))
+            img_lst.append(image)
+        animations[name] = tuple(tuple(img_lst[row * cols:(row + 1) * cols]) for row in range(anim["rows"]))
+
+    return animations
+
+def direction_rows(table, directions):
+    ''' returns the rows of a frame table by direction index. Animations
+        without directions show all their frames whichever way the object
+        faces, and missing diagonals show their left or right row '''
+
+    if directions == None:
+        return [sum(table, ())] * len(DIRECTIONS)
+
+    rows = [None] * len(DIRECTIONS)
+    for name, row in zip(directions, table):
+        rows[DIRECTION_NAMES[name]] = row
+    for direction in DIRECTIONS:
+        if rows[direction] == None:
+            rows[direction] = rows[DIRECTION_FALLBACK[direction]]
+    return rows
+
+def get_anchor(anchor, direction, image_size, size):
+    ''' returns the offset of a rect from the object's position and the
+        rect's size. centered rects have the image's size, facing rects
+        are beside the position on the left and right, and top-left rects
+        keep the size given '''
+
+    width, height = image_size
+    if anchor == "top-left":
+        return (0, 0) + tuple(size)
+    elif anchor == "facing" and direction == RIGHT:
+        return (0, -height / 2, width, height)
+    elif anchor == "facing" and direction == LEFT:
+        return (-width, -height / 2, width, height)
+    return (-width / 2, -height / 2, width, height)
 
-    # if the frame is the last one in the attacking frames
-    if character.frame == len(character.attack_frames_u) - 2:
-        character.give_damage_state = True
-    else:
-        character.give_damage_state = False
-        
 def set_rect(obj):
-    ''' updates the rect of the object '''
-    
-    # update the rect of the player to properly position the attack frame
-    if type(obj) == Player:
-        obj.rect = obj.image.get_rect()
-        if obj.attack_state:
-            if obj.direction in [DOWN, UP]:
-                obj.rect.x = SCREENWIDTH/2 - (obj.rect.width)/2
-                obj.rect.y = SCREENHEIGHT/2 - (obj.rect.height)/2
-            elif obj.direction == RIGHT:
-                obj.rect.x = SCREENWIDTH/2
-                obj.rect.y = SCREENHEIGHT/2 - (obj.rect.height)/2
-            elif obj.direction == LEFT:
-                obj.rect.x = SCREENWIDTH/2 - obj.rect.width
-                obj.rect.y = SCREENHEIGHT/2 - (obj.rect.height)/2
-            else:
-                obj.rect.x = SCREENWIDTH/2 - (obj.rect.width)/2
-                obj.rect.y = SCREENHEIGHT/2 - (obj.rect.height)/2
-        else:
-            obj.rect.x = SCREENWIDTH/2 - (obj.rect.width)/2
-            obj.rect.y = SCREENHEIGHT/2 - (obj.rect.height)/2
-            
-    # the monster's attack frames are less complex for now
+    ''' updates the world rect of the object from its co-ordinates and
+        the anchor of the frame shown '''
+
+    # range attacks move their rect themselves
+    if obj.anchor == None:
+        return
+
+    offset_x, offset_y, width, height = obj.anchor
+    if obj.rect == None:
+        obj.rect = pygame.Rect(0, 0, width, height)
     else:
-        # initialize the rect
-        if obj.rect == None:
-            obj.rect = obj.image.get_rect()
-            return
-        else:
-            # if we are already initialized, set the new rect with the current image
-            rect_x, rect_y = obj.rect.x, obj.rect.y
-            obj.rect.x, obj.rect.y = rect_x, rect_y
+        obj.rect.width, obj.rect.height = width, height
+    obj.rect.x = obj.pos_x + offset_x
+    obj.rect.y = obj.pos_y + offset_y
 
 def update_obj_coordinate(obj):
     ''' updates the x and y coordinates of an object '''
 
     # the distance travelled is equal to the objects's speed
-    distance = obj.speed
-        
-    if obj.direction == DOWN_RIGHT:
-        obj.pos_x += distance
-        obj.pos_y += distance
-    elif obj.direction == UP_RIGHT:
-        obj.pos_x += distance
-        obj.pos_y -= distance
-    elif obj.direction == DOWN_LEFT:
-        obj.pos_x -= distance
-        obj.pos_y += distance
-    elif obj.direction == UP_LEFT:
-        obj.pos_x -= distance
-        obj.pos_y -= distance
-    elif obj.direction == RIGHT:
-        obj.pos_x += distance
-    elif obj.direction == LEFT:
-        obj.pos_x -= distance
-    elif obj.direction == UP:
-        obj.pos_y -= distance
-    elif obj.direction == DOWN:
-        obj.pos_y += distance
-
-def set_attack_frame(obj, frame):
-    ''' determines which frame is set for a char attack based on direction '''
-
-    if obj.direction == UP_RIGHT:
-        obj.image = obj.attack_frames_ur[frame]
-    elif obj.direction == UP_LEFT:
-        obj.image = obj.attack_frames_ul[frame]
-    elif obj.direction == DOWN_RIGHT:
-        obj.image = obj.attack_frames_dr[frame]
-    elif obj.direction == DOWN_LEFT:
-        obj.image = obj.attack_frames_dl[frame]
-    elif obj.direction == RIGHT:
-        obj.image = obj.attack_frames_r[frame]
-    elif obj.direction == LEFT:
-        obj.image = obj.attack_frames_l[frame]
-    elif obj.direction == UP:
-        obj.image = obj.attack_frames_u[frame]
-    elif obj.direction == DOWN:
-        obj.image = obj.attack_frames_d[frame]
-    obj.frame += 1
-
-def set_spell_frame(obj, frame):
-    ''' determines which frame is set for a spell cast based on direction '''
-
-    if obj.direction == UP_RIGHT:
-        obj.image = obj.spell_frames_ur[frame]
-    elif obj.direction == UP_LEFT:
-        obj.image = obj.spell_frames_ul[frame]
-    elif obj.direction == DOWN_RIGHT:
-        obj.image = obj.spell_frames_dr[frame]
-    elif obj.direction == DOWN_LEFT:
-        obj.image = obj.spell_frames_dl[frame]
-    elif obj.direction == RIGHT:
-        obj.image = obj.spell_frames_r[frame]
-    elif obj.direction == LEFT:
-        obj.image = obj.spell_frames_l[frame]
-    elif obj.direction == UP:
-        obj.image = obj.spell_frames_u[frame]
-    elif obj.direction == DOWN:
-        obj.image = obj.spell_frames_d[frame]
-    obj.frame += 1
-
-def set_dead_frame(obj, frame):
-    ''' determines which frame is set for a dead state '''
-
-    obj.image = obj.dead_frames[frame]
-    obj.frame += 1
-
-def set_collide_frame(obj, frame):
-    ''' determines which frame is set for a collide state '''
-
-    obj.image = obj.collide_frames[frame]
-    obj.frame += 1
-
-def set_move_frame(obj, frame):
-    ''' determines which frame is set for a move frame based on direction '''
-
-    if obj.direction == UP_RIGHT:
-        obj.image = obj.move_frames_ur[frame]
-    elif obj.direction == UP_LEFT:
-        obj.image = obj.move_frames_ul[frame]
-    elif obj.direction == DOWN_RIGHT:
-        obj.image = obj.move_frames_dr[frame]
-    elif obj.direction == DOWN_LEFT:
-        obj.image = obj.move_frames_dl[frame]
-    elif obj.direction == RIGHT:
-        obj.image = obj.move_frames_r[frame]
-    elif obj.direction == LEFT:
-        obj.image = obj.move_frames_l[frame]
-    elif obj.direction == UP:
-        obj.image = obj.move_frames_u[frame]
-    elif obj.direction == DOWN:
-        obj.image = obj.move_frames_d[frame]
-
-    if type(obj) in [Player, Monster] and obj.target_pos != (None, None):
-        obj.frame += 1
+    step_x, step_y = DIRECTION_VECTOR[obj.direction]
+    obj.pos_x += step_x * obj.speed
+    obj.pos_y += step_y * obj.speed
+
+def show_frame(obj, action, frame):
+    ''' shows a frame of an action in the direction the object faces '''
+
+    obj.image = action.frames[obj.direction][frame]
+    if action.anchors != None:
+        obj.anchor = action.anchors[obj.direction][frame]
             
 def set_frame(obj):
-    ''' changes which frame is shown for an object '''
+    ''' changes which frame is shown for an object, playing the first
+        action of its definition whose state is set '''
+
+    definition = obj.definition
+
+    # if the character previously attacked
+    if obj.timer_for_attack > 0:
+        obj.timer_for_attack -= 1
+
+    # actions with a cooldown wait until the last one has finished
+    for action in definition.actions:
+        if action.state == None:
+            break
+        if getattr(obj, action.state) and not (action.cooldown and obj.timer_for_attack > 0):
+            break
 
     # position frame is determined by counter
     frame = obj.frame
 
-    # if the object is a Range_Attack
-    if type(obj) == Range_Attack:
-        if obj.collide:
-            action_frame_length = len(obj.collide_frames)
-            if frame < action_frame_length - 1:
-                set_collide_frame(obj, frame)
-            else:
-                pygame.sprite.Sprite.kill(obj)
-                obj.frame = 0
-            return
-        else:
-            action_frame_length = len(obj.move_frames_u)
-            if frame == action_frame_length - 1:
-                obj.frame = 0
-            else:
-                set_move_frame(obj, frame)
+    if action.damage_frame != None:
+        obj.give_damage_state = frame == action.damage_frame
+    if action.cast_frame != None:
+        obj.cast_state = frame == action.cast_frame
+
+    # one-shot actions end on their second last frame
+    if not action.loop:
+        if frame < action.count - 1:
+            show_frame(obj, action, frame)
+            obj.frame += 1
+        elif action.kill:
+            obj.kill()
+            obj.frame = 0
             return
-    
-    # if the character previously attacked
-    if type(obj) in [Monster, Player]:
-        if obj.timer_for_attack > 0:
-            obj.timer_for_attack -= 1
-        
-    # if the character can attack, show an attack frame
-    if obj.attack_state and obj.timer_for_attack == 0:
-        set_damage_state(obj)
-        action_frame_length = len(obj.attack_frames_u)
-        if frame < action_frame_length - 1:
-            set_attack_frame(obj, frame)
-        else:
-            set_attack_timer(obj)
-            frame = obj.frame
-            set_move_frame(obj, frame)
-
-    # if the character can cast a spell, show an attack frame
-    elif obj.spell_state and obj.timer_for_attack == 0:
-        action_frame_length = len(obj.spell_frames_u)            
-        if frame < action_frame_length - 1:
-            set_spell_frame(obj, frame)
-        else:
-            set_attack_timer(obj)
-            frame = obj.frame
-            set_move_frame(obj, frame)
-
-    # if the player is dead, show a dying frame
-    elif obj.dead_state:
-        action_frame_length = len(obj.dead_frames)
-        if frame < action_frame_length - 1:
-            set_dead_frame(obj, frame)
         else:
-            pygame.sprite.Sprite.kill(obj)
-            
+            # wait before the action can start again and show the base action
+            obj.timer_for_attack = action.cooldown
+            setattr(obj, action.state, False)
+            obj.frame = 0
+            base = definition.actions[-1]
+            show_frame(obj, base, 0)
+            if base.walk and obj.target_pos != (None, None):
+                obj.frame += 1
+
     # if the character is stopped, show a stopped frame
-    elif obj.target_pos == (None, None):
+    elif action.walk and obj.target_pos == (None, None):
         obj.frame = 0
-        set_move_frame(obj, obj.frame)
+        show_frame(obj, action, 0)
 
-    # the character is not stopped 
+    # loop the action, walking characters move too
     else:
-        action_frame_length = len(obj.move_frames_u)
-        set_move_frame(obj, frame)
-        update_obj_coordinate(obj)
-        
-        if type(obj) == Player: 
-            # move the screen top-left coordinate by changing global variable
-            update_screen_coordinate(obj.direction, obj.speed)
-        
-        if frame == action_frame_length - 1:
+        show_frame(obj, action, frame)
+        if frame == action.count - 1:
             obj.frame = 0
+        else:
+            obj.frame += 1
+        if action.walk:
+            update_obj_coordinate(obj)
             
     set_rect(obj)
 
@@ -695,152 +3059,106 @@ def set_direction(obj):
 
     # if a target_pos is set
     if obj.target_pos != (None, None):
-        
-        # ordinal directions
-        if (obj.pos_x < obj.target_pos[0] - position_margin) and (obj.pos_y < obj.target_pos[1] - position_margin):
-            obj.direction = DOWN_RIGHT
-        elif (obj.pos_x > obj.target_pos[0] + position_margin) and (obj.pos_y < obj.target_pos[1] - position_margin):
-            obj.direction = DOWN_LEFT
-        elif (obj.pos_x < obj.target_pos[0] - position_margin) and (obj.pos_y > obj.target_pos[1] + position_margin):
-            obj.direction = UP_RIGHT
-        elif (obj.pos_x > obj.target_pos[0] + position_margin) and (obj.pos_y > obj.target_pos[1] + position_margin):
-            obj.direction = UP_LEFT
-
-        # cardinal directions
-        elif obj.pos_x > obj.target_pos[0] + position_margin:
-            obj.direction = LEFT
-        elif obj.pos_x < obj.target_pos[0] - position_margin:
-            obj.direction = RIGHT
-        elif obj.pos_y < obj.target_pos[1] - position_margin:
-            obj.direction = DOWN
-        elif obj.pos_y > obj.target_pos[1] + position_margin:
-            obj.direction = UP
+
+        # the step towards the target along each axis, 0 when within the margin
+        step_x = (obj.pos_x < obj.target_pos[0] - position_margin) - (obj.pos_x > obj.target_pos[0] + position_margin)
+        step_y = (obj.pos_y < obj.target_pos[1] - position_margin) - (obj.pos_y > obj.target_pos[1] + position_margin)
 
         # we have hit the destination
-        else:
+        if step_x == 0 and step_y == 0:
             obj.target_pos = (None, None)
+        else:
+            obj.direction = VECTOR_DIRECTION[(step_x, step_y)]
 
 def image_parser(path, key):
     ''' removes the background color of the image based on the key '''
 
     # convert the file to an Image
-    image = pygame.image.load(path).convert()
+    return convert_image(pygame.image.load(path), key)
+
+def convert_image(image, key):
+    ''' converts a loaded image for fast blitting and removes its
+        background color, on the main thread '''
+
+    image = image.convert()
 
     # remove the background
     image.set_colorkey(key)
 
     return image
 
-def sort_lst(lst):
-    ''' mutates lst to a sorted list based on digits in files
-        uses the selection sort algorithm          '''
-    
-    for select in range(len(lst)):
-        pos = 0
-        # from 0 to select is sorted
-        for item in range(select,len(lst)):
-            index = ''
-            # find the digits in each image file
-            for letter in lst[item]:
-                if letter.isdigit():
-                    index += letter
-            if int(index) == select:
-                pos = item
-        val = lst.pop(pos)
-        lst.insert(select,val)
-
-def sort_images(obj, img_lst, rows, cols, action):
-    ''' sorts images for all object positions
-        into the respective object MOVE / ATTACK / SPELL lst '''
-
-    # starting cell in the table
-    cellindex = 0
-
-    # we know the image is of the character class
-    if action == MOVE:
-        # creates a table to produce different ranges of images
-        for row in range(rows):
-            for col in range(cols):
-                img = img_lst[cellindex]
-                obj.move_tup[row].append(img)
-                cellindex += 1
-                
-    elif action == COLLIDE:
-        for col in range(cols):
-            img = img_lst[cellindex]
-            obj.collide_frames.append(img)
-            cellindex += 1
-                    
-    elif action == ATTACK:
-        for row in range(rows):
-            for col in range(cols):
-                img = img_lst[cellindex]
-                obj.attack_tup[row].append(img)
-                cellindex += 1
-
-    elif action == SPELL:
-        for row in range(rows):
-            for col in range(cols):
-                img = img_lst[cellindex]
-                obj.spell_tup[row].append(img)
-                cellindex += 1
-
-    elif action == DEAD:
-        for row in range(rows):
-            for col in range(cols):
-                img = img_lst[cellindex]
-                obj.dead_frames.append(img)
-                cellindex += 1
-
-def check_collision(obj, layers, other_game_objects):
+def check_collision(obj, collision_grid, other_game_objects, spatial_hash):
     ''' checks if there is a collision between layers or other game_objects'''
 
     obj.collide = False
-    move_object(obj, obj.direction)
-    for layer in layers.values():
-        if layer[1]:
-            if pygame.sprite.spritecollideany(obj, layer[0]):
-                obj.collide = True
-    
+    if collision_grid.first_hit_along(obj.rect, obj.direction, obj.speed) != None:
+        obj.collide = True
+
+    # where the object will be after its next move
+    step_x, step_y = DIRECTION_VECTOR[obj.direction]
+    next_rect = obj.rect.move(step_x * obj.speed, step_y * obj.speed)
+    hit_object = False
+    for sprite in spatial_hash.query_rect(next_rect):
+        if sprite in other_game_objects:
+            hit_object = True
+            break
+
     if type(obj) == Monster:
-        if pygame.sprite.spritecollideany(obj, other_game_objects):
+        if hit_object:
             obj.spell_state = True
-            obj.collide = True
         else:
             obj.spell_state = False
-    if pygame.sprite.spritecollideany(obj, other_game_objects):
+    if hit_object:
             obj.collide = True
-            
-    move_object(obj, OPPOSITE_DIRECTION[obj.direction])
+
     if obj.collide:
         obj.target_pos = (None,None)
 
+def extrapolate(obj, elapsed, collision_grid):
+    ''' carries a hibernating object on towards its target for elapsed
+        ticks without thinking, at most AI_FAR_INTERVAL of them. It stops
+        at the target, short of the first wall on the way, or where it
+        is if it would still end up in a wall '''
+
+    if obj.target_pos == (None, None) or obj.spell_state or obj.dead_state:
+        return
+
+    step_x, step_y = DIRECTION_VECTOR[obj.direction]
+    distance = obj.speed * min(elapsed, AI_FAR_INTERVAL)
+    pos_x, pos_y = obj.pos_x, obj.pos_y
+    move_x = min(distance, abs(obj.target_pos[0] - pos_x))
+    move_y = min(distance, abs(obj.target_pos[1] - pos_y))
+
+    # the rect is swept as far as it goes along either axis
+    reach = max(move_x if step_x else 0, move_y if step_y else 0)
+    hit = collision_grid.first_hit_along(obj.rect, obj.direction, math.ceil(reach))
+    if hit != None:
+        move_x, move_y = min(move_x, hit), min(move_y, hit)
+        obj.target_pos = (None, None)
+
+    obj.pos_x += step_x * move_x
+    obj.pos_y += step_y * move_y
+    set_rect(obj)
+
+    if collision_grid.is_blocked(obj.rect):
+        obj.pos_x, obj.pos_y = pos_x, pos_y
+        obj.target_pos = (None, None)
+        set_rect(obj)
+
+def sprite_position(obj):
+    ''' returns the position of an object, range attacks only move their rect '''
+
+    if type(obj) == Range_Attack:
+        return (obj.rect.x, obj.rect.y)
+    return (obj.pos_x, obj.pos_y)
+
 def move_object(obj, direction):
     ''' test collisions, moves objects '''
 
     # the distance travelled is equal to the objects's speed
-    distance = obj.speed
-
-    if direction == DOWN_RIGHT:
-        obj.rect.x += distance
-        obj.rect.y += distance
-    elif direction == UP_RIGHT:
-        obj.rect.x += distance
-        obj.rect.y -= distance
-    elif direction == DOWN_LEFT:
-        obj.rect.x -= distance
-        obj.rect.y += distance
-    elif direction == UP_LEFT:
-        obj.rect.x -= distance
-        obj.rect.y -= distance
-    elif direction == RIGHT:
-        obj.rect.x += distance
-    elif direction == LEFT:
-        obj.rect.x -= distance
-    elif direction == UP:
-        obj.rect.y -= distance
-    elif direction == DOWN:
-        obj.rect.y += distance
+    step_x, step_y = DIRECTION_VECTOR[direction]
+    obj.rect.x += step_x * obj.speed
+    obj.rect.y += step_y * obj.speed
 
 def create_item(item_sprite_lst, item):
     ''' creates an image to appear on the map '''
@@ -850,7 +3168,7 @@ def create_item(item_sprite_lst, item):
 def create_range_attack_rect(range_attack_obj, character):
     ''' creates the rect of the obj based on character's position '''
 
-    range_attack_obj.rect = range_attack_obj.image.get_rect()
+    range_attack_obj.rect.size = range_attack_obj.image.get_size()
 
     if range_attack_obj.direction == RIGHT:
         rect_x, rect_y = character.rect.x + character.rect.width, character.rect.y
@@ -866,12 +3184,12 @@ def create_range_attack_rect(range_attack_obj, character):
         
     range_attack_obj.rect.x, range_attack_obj.rect.y = rect_x, rect_y
         
-def check_attack(char, game_object_lst):
+def check_attack(char, game_object_lst, spatial_hash):
     ''' check if the character's attack has collided with any object
-        in other_char_lst '''
+        in game_object_lst, and returns how many it hit '''
 
     # find all collisions from the attack
-    char_damaged_lst = (pygame.sprite.spritecollide(char, game_object_lst, False))
+    char_damaged_lst = [obj for obj in spatial_hash.query_rect(char.rect) if obj in game_object_lst]
 
     for dam_char in char_damaged_lst:
         dam_char.health -= 20
@@ -879,259 +3197,740 @@ def check_attack(char, game_object_lst):
             dam_char.frame = 0
             dam_char.dead_state = True
 
-def update_screen_coordinate(direction, distance):
-    ''' changes the coordinate of the screen (TOP-LEFT is 0,0) '''
-
-    global SCREEN_POS_X, SCREEN_POS_Y
-
-    if direction == DOWN_RIGHT:
-        SCREEN_POS_X += distance
-        SCREEN_POS_Y += distance
-    elif direction == UP_RIGHT:
-        SCREEN_POS_X += distance
-        SCREEN_POS_Y -= distance
-    elif direction == DOWN_LEFT:
-        SCREEN_POS_X -= distance
-        SCREEN_POS_Y += distance
-    elif direction == UP_LEFT:
-        SCREEN_POS_X -= distance
-        SCREEN_POS_Y -= distance
-    elif direction == RIGHT:
-        SCREEN_POS_X += distance
-    elif direction == LEFT:
-        SCREEN_POS_X -= distance
-    elif direction == UP:
-        SCREEN_POS_Y -= distance
-    elif direction == DOWN:
-        SCREEN_POS_Y += distance
-        
-def main():
-        
-        global FPSCLOCK, SCREEN, SCREEN_POS_X, SCREEN_POS_Y
-        pygame.init()
+    return len(char_damaged_lst)
 
-        # if android is available
-        if android:
-                android.init()
-                android.map_key(android.KEYCODE_BACK, pygame.K_ESCAPE)
+class World():
+    ''' everything simulated in the game. step() runs one tick of the
+        game logic without drawing anything, so it also runs headless.
+        map_data is what create_map returned when the map was already
+        loaded. With entity_store None the monsters go in an Entity_Store
+        only on maps with ENTITY_STORE_THRESHOLD monsters or more. Without
+        spawn_monsters the world starts empty of monsters until
+        spawn_monsters() is called, once their animations are loaded '''
 
-        # setup the game window      
-        FPSCLOCK = pygame.time.Clock()
-        SCREEN = pygame.display.set_mode((SCREENWIDTH, SCREENHEIGHT))
-        pygame.display.set_caption('PYTHON GAME')
+    def __init__(self, map_file, animation_bank=None, entity_store=ENTITY_STORE, map_data=None,
+                 spawn_monsters=True):
 
         # retrieve map data
-        layers, objects = create_map("game_map.json")
+        if map_data == None:
+            map_data = create_map(map_file)
+        self.layers, self.objects, self.collision_grid, self.path_graph = map_data
 
         # declare sprite groups
-        monster_sprite_list = pygame.sprite.Group()
-        active_sprite_list = pygame.sprite.Group()
-        item_sprite_list = pygame.sprite.Group()
-        range_attack_sprite_list = pygame.sprite.Group()
-
-        # create range item images
-        # for now just create a fire spell
-        fire_spell = Range_Attack(20)
-        fire_spell_sprite_lst = create_sprite_frames('\\fire_spell','fire_spell',BLACK)
-        fire_spell_collide_lst = create_sprite_frames('\\fire_spell','fire_collide',BLACK)
-        sort_images(fire_spell, fire_spell_sprite_lst, 8, 8, MOVE)
-        sort_images(fire_spell, fire_spell_collide_lst, 1, 15, COLLIDE)
+        self.active_sprite_list = pygame.sprite.Group()
+        self.item_sprite_list = pygame.sprite.Group()
+
+        # where the sprites near the camera were before the last tick, for interpolation
+        self.previous = {}
+
+        # range attacks are records of a pool, kept for the whole game
+        self.range_attack_sprite_list = Range_Attack_Pool(previous=self.previous)
+
+        # all live characters by where they are in the world
+        self.spatial_hash = Spatial_Hash(SPATIAL_HASH_CELL)
+
+        # every animation is loaded once and shared, worlds can share a bank
+        if animation_bank == None:
+            animation_bank = Animation_Bank()
+        self.animation_bank = animation_bank
+
+        # the monsters are sprites in the spatial hash, or rows of an entity
+        # store when numpy is installed. monster_hash finds them by rect
+        if entity_store == None:
+            spawns = [obj for obj in self.objects['spawn_objects'] if obj["name"][:7] == "monster"]
+            entity_store = len(spawns) >= ENTITY_STORE_THRESHOLD
+        self.entity_store = entity_store and numpy != None
+        self.monster_sprite_list = pygame.sprite.Group()
+        self.monster_hash = self.spatial_hash
+
+        # the steps towards the player, shared by every monster chasing them
+        self.flow_field = None
+
+        # which monsters think each tick, by their distance to the player
+        self.ai_scheduler = AI_Scheduler()
+
+        # every fire spell shares the frames of its definition
+        self.fire_spell = self.animation_bank.define(self.range_attack_sprite_list, 'fire_spell')
         
         # initialize all frames of the player
-        player = Player(5)
-        move_pos_lst = create_sprite_frames('\orc_char','orc_move',BLACK)
-        attack_pos_lst = create_sprite_frames('\orc_char','orc_attack',BLACK)
-        spell_pos_lst = create_sprite_frames('\orc_char','orc_spell',BLACK)
-        dead_pos_lst = create_sprite_frames('\orc_char','orc_dead',BLACK)
-
-        # add the images to the player
-        sort_images(player, move_pos_lst, 8, 9, MOVE)
-        sort_images(player, attack_pos_lst, 8, 6, ATTACK)
-        sort_images(player, spell_pos_lst, 8, 7, SPELL)
-        sort_images(player, dead_pos_lst, 1, 6, DEAD)
-        active_sprite_list.add(player)
-        
-        # update the player based on the starting direction
-        set_frame(player)
+        self.player = Player(5)
+        self.animation_bank.define(self.player, 'orc')
+        self.active_sprite_list.add(self.player)
 
-        # setup the player to be in the middle of the screen
-        player.rect = player.image.get_rect()
-        distance_to_screen_left = SCREENWIDTH/2 - (player.rect.width)/2
-        distance_to_screen_top = SCREENHEIGHT/2 - (player.rect.height)/2
-        player.rect.x = distance_to_screen_left
-        player.rect.y = distance_to_screen_top
+        # number of ticks simulated so far
+        self.tick = 0
 
-        # create the spawn points for the player and monsters
-        for obj in objects['spawn_objects']:
+        # the sound effects of the events of the last tick, for Audio.play_events
+        self.sounds = []
+
+        # create the spawn point for the player
+        for obj in self.objects['spawn_objects']:
             if obj["name"] == "char_spawn":
-                SCREEN_POS_X = obj["x"] - distance_to_screen_left
-                SCREEN_POS_Y = obj["y"] - distance_to_screen_top
-                player.pos_x = obj["x"]
-                player.pos_y = obj["y"]
-                for layer in layers.values():
-                    for sprites in layer[0].sprites():
-                        # move the map so that the middle is at the spawn point
-                        sprites.setup_player_spawn(obj["x"],obj["y"])
-
-            # if the spawn point is for a monster            
+                self.player.pos_x = obj["x"]
+                self.player.pos_y = obj["y"]
+
+                # update the player based on the starting direction
+                set_frame(self.player)
+                self.spatial_hash.update(self.player)
+
+        if spawn_monsters:
+            self.spawn_monsters()
+
+        # times the phases of each tick and frame when turned on
+        self.profiler = Frame_Profiler()
+
+        # everything drawn by draw(), kept between frames
+        self.render_queue = Render_Queue()
+
+    def spawn_monsters(self):
+        ''' sets up the monsters and spawns one at each of their spawn points '''
+
+        if self.entity_store:
+            self.monster_sprite_list = Entity_Store(self.animation_bank, self.collision_grid)
+            self.monster_hash = self.monster_sprite_list
+
+        self.flow_field = Flow_Field(self.collision_grid, self.animation_bank.definition('skeleton').size)
+
+        # if the spawn point is for a monster
+        for obj in self.objects['spawn_objects']:
             if obj["name"][:7] == "monster":
+                self.spawn_monster(obj["x"], obj["y"])
+
+    def spawn_monster(self, pos_x, pos_y):
+        ''' creates a skeleton at the world position '''
+
+        if type(self.monster_sprite_list) == Entity_Store:
+            return self.monster_sprite_list.add(pos_x, pos_y, 3, self.tick)
+
+        # create monster and share the skeleton frames with it
+        monster = Monster(3)
+        self.animation_bank.define(monster, 'skeleton')
+        monster.ai_tick = self.tick - 1
+
+        # setup position
+        monster.pos_x = pos_x
+        monster.pos_y = pos_y
+
+        # setup the starting frame of the monster
+        set_frame(monster)
+
+        self.monster_sprite_list.add(monster)
+        self.spatial_hash.update(monster)
+        return monster
+
+    def step(self, inputs):
+        ''' runs one tick of the game. inputs is a list of (action, value)
+            pairs from the player: (MOVE, world position), (ATTACK, None)
+            or (SPELL, None) '''
+
+        player = self.player
+        spatial_hash = self.spatial_hash
+        collision_grid = self.collision_grid
+        profiler = self.profiler
+        sounds = self.sounds
+        del sounds[:]
+
+        profiler.mark("player")
+        for action, value in inputs:
+            if action == MOVE:
+                player.target_pos = value
+            elif action == ATTACK:
+                player.attack_state = True
+            elif action == SPELL:
+                player.spell_state = True
+
+        # update the player's frame based on direction
+        if player.attack_state or player.spell_state:
+            player.target_pos = (None, None)
+            
+        set_direction(player)
+        
+        # check if a collision exists between the player and the map, if the player isn't attacking
+        if not player.attack_state:
+            check_collision(player, collision_grid, self.monster_sprite_list, self.monster_hash)
+        set_frame(player)
+        spatial_hash.update(player)
+
+        # if the player attack, see if he hit anything
+        if player.give_damage_state:
+            sounds.append('attack')
+            if check_attack(player, self.monster_sprite_list, self.monster_hash):
+                sounds.append('hit')
+
+        # change the frame for all range attacks
+        profiler.mark("range attacks")
+        if self.range_attack_sprite_list.step(collision_grid, self.active_sprite_list, spatial_hash):
+            sounds.append('spell_hit')
+
+        # if the player's spell reached its casting frame
+        if player.cast_state:
+            if self.range_attack_sprite_list.cast(self.fire_spell, player, FIRE_SPELL_SPEED) != None:
+                sounds.append('spell')
+
+        # every monster close enough to see the player
+        profiler.mark("monsters")
+        scheduler = self.ai_scheduler
+        scheduler.begin()
+        if self.flow_field == None:
+            self.tick += 1
+            return
+        self.flow_field.update(player.pos_x, player.pos_y)
+        if type(self.monster_sprite_list) == Entity_Store:
+            self.monster_sprite_list.step(player, self.active_sprite_list, self.flow_field, self.path_graph,
+                                          scheduler, self.tick)
+            self.tick += 1
+            return
+        near_player = spatial_hash.query_radius(player.pos_x, player.pos_y, AGGRO_RADIUS)
+
+        # only monsters due this tick are updated, the most overdue first so
+        # those the AI time budget left over last tick go ahead of the rest
+        due = []
+        for sprite in self.monster_sprite_list.sprites():
+            level = scheduler.level(sprite, player)
+            if self.tick - sprite.ai_tick >= scheduler.intervals[level]:
+                due.append((sprite, level))
+        due.sort(key=lambda entry: entry[0].ai_tick)
+
+        for sprite, level in due:
+            elapsed = self.tick - sprite.ai_tick
+            if not scheduler.due(level, elapsed):
+                continue
+            sprite.ai_tick = self.tick
+
+            # hibernating monsters are only carried on towards their target
+            if level == scheduler.FAR:
+                extrapolate(sprite, elapsed, collision_grid)
+                spatial_hash.update(sprite)
+                continue
+
+            # monsters which missed ticks move as far as they would have in a few of them
+            speed = sprite.speed
+            sprite.speed *= min(elapsed, AI_MID_INTERVAL)
+            sprite.set_find_player_state(near_player)
+            sprite.set_target_pos(player, self.flow_field, self.path_graph)
+            set_direction(sprite)
+            check_collision(sprite, collision_grid, self.active_sprite_list, spatial_hash)
+            set_frame(sprite)
+            sprite.speed = speed
+            spatial_hash.update(sprite)
+            if sprite.give_damage_state:
+                sounds.append('attack')
+                if check_attack(sprite, self.active_sprite_list, spatial_hash):
+                    sounds.append('hit')
+
+        self.tick += 1
+
+    def snapshot(self, camera):
+        ''' remembers where the sprites near the camera are before a tick,
+            so drawing can move them smoothly from there '''
+
+        previous = self.previous
+        previous.clear()
+        view = camera.rect.inflate(SPATIAL_HASH_CELL * 2, SPATIAL_HASH_CELL * 2)
+        for group in self.sprite_groups(view):
+            for sprite in group:
+                if view.colliderect(sprite.rect):
+                    previous[sprite] = sprite_position(sprite)
+
+    def offset(self, sprite, alpha):
+        ''' returns how far from its position a sprite is drawn, alpha of
+            the way from where it was before the last tick to where it is '''
+
+        last = self.previous.get(sprite)
+        if last == None:
+            return (0, 0)
+        pos_x, pos_y = sprite_position(sprite)
+        return (round((last[0] - pos_x) * (1 - alpha)), round((last[1] - pos_y) * (1 - alpha)))
+
+    def draw(self, surface, camera, alpha=1.0):
+        ''' draws the map and every sprite the camera can see, and returns
+            how many map chunks and tiles were drawn '''
+
+        queue = self.render_queue
+        queue.clear()
+        drawn = self.submit(queue, camera, self.visible_sprites(camera, alpha))
+        self.profiler.mark("flush")
+        queue.flush(surface)
+        return drawn
+
+    def submit(self, queue, camera, sprites):
+        ''' submits the map chunks the camera can see and the sprites, as
+            visible_sprites returns them, to the render queue, and returns
+            how many map chunks and tiles were submitted '''
+
+        # queue the map
+        self.profiler.mark("map")
+        chunks = 0
+        tiles = 0
+        for layer in self.layers.values():
+            layer_chunks, layer_tiles = layer[0].submit(queue, camera)
+            chunks += layer_chunks
+            tiles += layer_tiles
+
+        # characters further down are in front
+        self.profiler.mark("sprites")
+        for image, dest in sprites.values():
+            queue.submit(image, dest, Render_Queue.ACTORS, dest[1] + image.get_height())
+
+        return chunks, tiles
+
+    def visible_sprites(self, camera, alpha=1.0):
+        ''' returns every sprite the camera can see with its image and the
+            screen position the image is drawn at, in drawing group order.
+            Below an alpha of 1 sprites are drawn between where they were
+            before the last tick and where they are '''
+
+        view = camera.rect
+        previous = self.previous if alpha < 1 else {}
+        sprites = {}
+        for group in self.sprite_groups(view):
+            for sprite in group:
+                image, rect = sprite.image, sprite.rect
+                if image != None and view.colliderect(rect):
+                    dest = (rect.x - view.x, rect.y - view.y)
+                    if sprite in previous:
+                        offset = self.offset(sprite, alpha)
+                        dest = (dest[0] + offset[0], dest[1] + offset[1])
+                    sprites[sprite] = (image, dest)
+        return sprites
+
+    def sprite_groups(self, view):
+        ''' returns the sprite groups in the order they are drawn, stored
+            monsters are only given when they are in the view '''
+
+        monsters = self.monster_sprite_list
+        if type(monsters) == Entity_Store:
+            monsters = monsters.query_rect(view)
+
+        return (self.active_sprite_list, monsters,
+                self.item_sprite_list, self.range_attack_sprite_list)
+
+    def checksum(self):
+        ''' returns a digest of where the player and every monster are and
+            how healthy they are, to tell if two runs ended the same '''
+
+        digest = hashlib.sha1()
+        for sprite in [self.player] + list(self.monster_sprite_list):
+            digest.update(struct.pack('<ddi', sprite.pos_x, sprite.pos_y, sprite.health))
+        return digest.digest()
+
+    def counts(self, chunks, tiles):
+        ''' returns the number of each kind of thing in the world, for the profiler '''
+
+        return {"monsters": len(self.monster_sprite_list),
+                "range attacks": len(self.range_attack_sprite_list),
+                "ai near": self.ai_scheduler.counts[AI_Scheduler.NEAR],
+                "ai mid": self.ai_scheduler.counts[AI_Scheduler.MID],
+                "ai far": self.ai_scheduler.counts[AI_Scheduler.FAR],
+                "ai deferred": self.ai_scheduler.deferred,
+                "chunks drawn": chunks,
+                "tiles drawn": tiles}
+
+class Input_Recorder():
+    ''' writes the player's inputs of every tick to a compact binary file,
+        with what a replay needs to run the same game again: the map, the
+        seed of the random module and how the monsters are stored. The
+        file is a header followed by one record per input, and the header
+        gets the number of ticks and a checksum of the end state on close '''
+
+    # magic, version, seed, entity store, ticks, checksum, length of the map file name
+    HEADER = struct.Struct('<4sHQ?I20sH')
+
+    # tick, action code, x, y
+    EVENT = struct.Struct('<IBii')
+
+    def __init__(self, file_name, world, map_file, seed):
+
+        self.world = world
+        self.map_file = map_file
+        self.seed = seed
+        self.entity_store = world.entity_store
+        self.ticks = 0
+
+        self.file = open(file_name, 'wb')
+        self.write_header(bytes(20))
+        self.file.write(map_file.encode())
+
+    def write_header(self, checksum):
+        ''' writes the header at the start of the file '''
+
+        self.file.seek(0)
+        self.file.write(self.HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, self.seed, self.entity_store,
+                                         self.ticks, checksum, len(self.map_file.encode())))
+
+    def record(self, inputs):
+        ''' writes the inputs of the next tick '''
+
+        for action, value in inputs:
+            pos_x, pos_y = value if value != None else (0, 0)
+            self.file.write(self.EVENT.pack(self.ticks, REPLAY_ACTIONS.index(action), pos_x, pos_y))
+        self.ticks += 1
+
+    def close(self):
+        ''' finishes the header with the state the world ended in '''
+
+        self.file.seek(0, os.SEEK_END)
+        end = self.file.tell()
+        self.write_header(self.world.checksum())
+        self.file.seek(end)
+        self.file.close()
+
+class Input_Replay():
+    ''' the inputs of a file written by Input_Recorder. create_world()
+        makes the world the recording started with, and feeding it
+        inputs() every tick plays the same game again. The AI time budget
+        depends on the machine, so recorded and replayed worlds run
+        without one '''
+
+    def __init__(self, file_name):
+
+        data = open(file_name, 'rb').read()
+        header = Input_Recorder.HEADER
+        magic, version, self.seed, self.entity_store, self.ticks, self.checksum, name_length = header.unpack_from(data)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError("%s is not a version %d replay" % (file_name, REPLAY_VERSION))
+        self.map_file = data[header.size:header.size + name_length].decode()
+
+        # the inputs of every tick with any, keyed by tick
+        self.events = {}
+        for tick, code, pos_x, pos_y in Input_Recorder.EVENT.iter_unpack(data[header.size + name_length:]):
+            action = REPLAY_ACTIONS[code]
+            self.events.setdefault(tick, []).append((action, (pos_x, pos_y) if action == MOVE else None))
+
+    def inputs(self, tick):
+        ''' returns the inputs of the tick '''
+
+        return self.events.get(tick, ())
+
+    def warning(self):
+        ''' returns why the replay cannot play the same game here, or None '''
+
+        if self.entity_store and numpy == None:
+            return "the replay kept its monsters in numpy, without it the monsters will wander differently"
+        return None
+
+    def create_world(self, animation_bank=None):
+        ''' returns the world the recording started with '''
+
+        random.seed(self.seed)
+        world = World(self.map_file, animation_bank, self.entity_store)
+        world.ai_scheduler.budget = None
+        return world
+
+    def run(self, animation_bank=None):
+        ''' replays every tick as fast as the CPU allows, and returns the
+            world and the seconds each tick took '''
+
+        world = self.create_world(animation_bank)
+        times = []
+        for tick in range(self.ticks):
+            start = time.perf_counter()
+            world.step(self.inputs(tick))
+            times.append(time.perf_counter() - start)
+        return world, times
+
+def run_replay(replay_file):
+    ''' replays a recording without a window as fast as the CPU allows,
+        prints its slowest ticks and whether it ended as recorded, and
+        returns the world '''
+
+    # SDL still needs a display to convert images, the dummy one shows nothing
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+
+    replay = Input_Replay(replay_file)
+    if replay.warning() != None:
+        print(replay.warning())
+    world, times = replay.run()
+
+    elapsed = sum(times)
+    print("%d ticks in %.3f seconds, %.0f ticks per second, %d monsters" %
+          (replay.ticks, elapsed, replay.ticks / max(elapsed, 1e-9), len(world.monster_sprite_list)))
+    slowest = sorted(range(len(times)), key=lambda tick: -times[tick])[:5]
+    print("slowest ticks: " + ", ".join("%d (%.2f ms)" % (tick, times[tick] * 1000) for tick in slowest))
+    if replay.checksum != bytes(20):
+        print("the replay ended %s the recording" % ("the same as" if world.checksum() == replay.checksum else "differently from"))
+    return world
+
+def quit_game(recorder=None):
+    ''' finishes the recording, if there is one, and leaves the game '''
+
+    if recorder != None:
+        recorder.close()
+    pygame.quit()
+    sys.exit()
+
+def run_headless(map_file, ticks):
+    ''' runs the simulation as fast as the CPU allows, without a window,
+        sound, text or a frame rate, and returns the world '''
+
+    # SDL still needs a display to convert images, the dummy one shows nothing
+    os.environ['SDL_VIDEODRIVER'] = 'dummy'
+    os.environ['SDL_AUDIODRIVER'] = 'dummy'
+    pygame.display.init()
+    pygame.display.set_mode((1, 1))
+
+    world = World(map_file)
+
+    start = time.perf_counter()
+    for tick in range(ticks):
+        world.step([])
+    elapsed = time.perf_counter() - start
+
+    print("%d ticks in %.3f seconds, %.0f ticks per second, %d monsters" %
+          (ticks, elapsed, ticks / max(elapsed, 1e-9), len(world.monster_sprite_list)))
+    return world
+
+def preload_tilesets(loader, group, map_data):
+    ''' decodes the tileset images of a loaded map on the loader's
+        threads, and returns the map '''
+
+    layers = map_data[0]
+    for layer in layers.values():
+        for tileset in layer[0].tilesets:
+            if tileset.image_source not in loader.groups[group]:
+                tileset.preload(loader, group)
 
-                # create monster and initialize frames
-                monster = Monster(3)
-                move_pos_lst = create_sprite_frames('\skeleton_char','skeleton_move',BLACK)
-                spell_pos_lst = create_sprite_frames('\skeleton_char','skeleton_spell',BLACK)
-                dead_pos_lst = create_sprite_frames('\skeleton_char','skeleton_dead',BLACK)
-    
-                # add the frames to the monster
-                sort_images(monster, move_pos_lst, 8, 9, MOVE)
-                sort_images(monster, spell_pos_lst, 8, 13, SPELL)
-                sort_images(monster, dead_pos_lst, 1, 6, DEAD)
+    return map_data
+
+def draw_loading_screen(surface, font, progress):
+    ''' draws a bar filled by the share of the assets loaded '''
 
-                # setup the starting frame of the monster
-                set_frame(monster)
+    surface.fill(BLACK)
+    bar = pygame.Rect(0, 0, surface.get_width() // 2, 20)
+    bar.center = (surface.get_width() // 2, surface.get_height() // 2)
+    pygame.draw.rect(surface, WHITE, bar, 1)
+    pygame.draw.rect(surface, WHITE, (bar.x, bar.y, int(bar.width * progress), bar.height))
+
+    text = font.render("Loading %d%%" % (progress * 100), True, WHITE)
+    surface.blit(text, text.get_rect(midbottom=(bar.centerx, bar.y - 10)))
+
+def main(map_file="game_map.json", record_file=None, replay_file=None, seed=None):
+        
+        global FPSCLOCK, SCREEN
+        pygame.init()
+
+        # a replay brings the map, seed and monster storage it was recorded with
+        replay = None
+        entity_store = ENTITY_STORE
+        if replay_file != None:
+            replay = Input_Replay(replay_file)
+            map_file, seed, entity_store = replay.map_file, replay.seed, replay.entity_store
+            if replay.warning() != None:
+                print(replay.warning())
+        if seed == None:
+            seed = random.getrandbits(64)
+
+        # the replay header keeps 64 bits of the seed, so the game is seeded with just those
+        seed &= 0xFFFFFFFFFFFFFFFF
+
+        # recorded and replayed games start with every monster and run without an AI time budget
+        deterministic = record_file != None or replay != None
+        groups = ['world', 'monsters'] if deterministic else ['world']
+
+        # if android is available
+        if android:
+                android.init()
+                android.map_key(android.KEYCODE_BACK, pygame.K_ESCAPE)
 
-                # setup position
-                monster.rect.x = obj["x"] - SCREEN_POS_X
-                monster.rect.y = obj["y"] - SCREEN_POS_Y
-                monster.pos_x = obj["x"]
-                monster.pos_y = obj["y"]
+        # setup the game window      
+        FPSCLOCK = pygame.time.Clock()
+        SCREEN = pygame.display.set_mode((SCREENWIDTH, SCREENHEIGHT))
+        pygame.display.set_caption('PYTHON GAME')
 
-                monster_sprite_list.add(monster)
+        fontObj = pygame.font.Font('freesansbold.ttf', 18)
+        fontObj_small = pygame.font.Font('freesansbold.ttf', 10)
 
+        # the files are decoded in the background, the game starts once the map,
+        # the player and the hud are loaded, the monsters and music follow
+        loader = Asset_Loader()
+        bank = Animation_Bank(atlas_file=None)
+        loader.request(map_file, 'world', create_map, (map_file,),
+                       lambda map_data: preload_tilesets(loader, 'world', map_data))
+        bank.preload_atlas(loader, 'world')
+        bank.preload(loader, 'world', 'orc')
+        bank.preload(loader, 'world', 'fire_spell')
+        for image_file in ['scroll_paper.png', 'orc_face.png']:
+            loader.request(image_file, 'world', pygame.image.load, (image_file,),
+                           lambda image: convert_image(image, BLACK))
+        bank.preload(loader, 'monsters', 'skeleton')
+
+        # the music streams from disk while everything loads, the effects are decoded once
+        audio = Audio()
+        audio.load_effects(loader, 'audio')
+        audio.play_music()
+
+        while not all(loader.ready(group) for group in groups):
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT or (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE):
+                    pygame.quit()
+                    sys.exit()
+            loader.pump()
+            draw_loading_screen(SCREEN, fontObj, loader.progress(*groups))
+            pygame.display.update()
+            FPSCLOCK.tick(FPS)
+
+        # spawn everything on the map, the monsters once they are loaded
+        random.seed(seed)
+        world = World(map_file, bank, entity_store, map_data=loader.get(map_file), spawn_monsters=deterministic)
+        player = world.player
+        profiler = world.profiler
+        if deterministic:
+            world.ai_scheduler.budget = None
+
+        # every tick's inputs are written to the recording
+        recorder = None
+        if record_file != None:
+            recorder = Input_Recorder(record_file, world, map_file, seed)
+
+        # the camera decides which part of the world is on the screen
+        # and starts with the player in the middle of the screen
+        camera = Camera(SCREENWIDTH, SCREENHEIGHT)
+        camera.follow(player)
+
+        # only the chunks around the player are kept baked
+        streamer = Chunk_Streamer(world.layers, STREAM_RADIUS, STREAM_MEMORY_BUDGET)
             
         # setup some text to be displayed
-        scroll_paper = image_parser('scroll_paper.png',BLACK)
-        orc_face = image_parser('orc_face.png',BLACK)
+        scroll_paper = loader.get('scroll_paper.png')
+        orc_face = loader.get('orc_face.png')
         orc_face = pygame.transform.scale(orc_face, (75,75))
         scroll_paper = pygame.transform.scale(scroll_paper, (200,400))
         scroll_paper = pygame.transform.rotate(scroll_paper, 90)
-        paper = image_parser('paper.png',BLACK)
-        
-        fontObj = pygame.font.Font('freesansbold.ttf', 18)
-        fontObj_small = pygame.font.Font('freesansbold.ttf', 10)
-        health_title = fontObj.render("Health: ", True, BLACK)
-        health_state = fontObj.render(str(player.health), True, BLACK)
-        health_state_rect =  health_title.get_rect()
-        health_title_rect = health_state.get_rect()
-        health_state_rect.center = (scroll_paper.get_width()/2+100, scroll_paper.get_height()/2)
-        health_title_rect.center = (scroll_paper.get_width()/2, scroll_paper.get_height()/2)
+
+        # the hud is composed once and again only when what it shows changes
+        text_cache = Text_Cache()
+        hud = Hud(scroll_paper, orc_face, fontObj, fontObj_small, text_cache)
+
+        # only the parts of the screen which changed are redrawn
+        renderer = Dirty_Renderer()
 
         # render paper
 
-        # game music
-        game_music = pygame.mixer.Sound('mozart.wav')
-        game_music.play()
+        # the mouse has not moved yet
+        mouse_pos = (0, 0)
+
+        # the game logic runs TICK_RATE ticks per second however fast frames are
+        # drawn, lag is the time it is behind the clock
+        tick_time = 1.0 / TICK_RATE
+        lag = 0.0
+        last_time = time.perf_counter()
+
+        # the player's input for the next tick
+        inputs = []
 
         # game loop
         while True:
+                profiler.begin_frame()
+                profiler.mark("events")
+
                 # handles each player driven event in the game
                 for event in pygame.event.get():
                     if event.type == pygame.MOUSEMOTION:
                         mouse_pos = pygame.mouse.get_pos()
-                        x = SCREEN_POS_X + mouse_pos[0] 
-                        y = SCREEN_POS_Y + mouse_pos[1]
                     if event.type == pygame.KEYDOWN:
                         if event.key == 115:
-                            player.spell_state = True
+                            inputs.append((SPELL, None))
                         elif event.key == pygame.K_SPACE:
-                            player.attack_state = True
+                            inputs.append((ATTACK, None))
+                        elif event.key == pygame.K_F3:
+                            profiler.toggle()
+                        elif event.key == pygame.K_F4:
+                            profiler.dump()
                         elif event.key == pygame.K_ESCAPE:
-                            pygame.quit()
-                            sys.exit()
+                            quit_game(recorder)
                     if event.type == pygame.QUIT:
-                            pygame.quit()
-                            sys.exit()
+                            quit_game(recorder)
+                    if event.type == pygame.VIDEOEXPOSE:
+                            renderer.invalidate()
                     if event.type == pygame.MOUSEBUTTONDOWN:
                             mouse_pos = pygame.mouse.get_pos()
-                            x = SCREEN_POS_X + mouse_pos[0] 
-                            y = SCREEN_POS_Y + mouse_pos[1]
-                            player.target_pos = (x, y)
-
-                # make the surface blank
-                SCREEN.fill((0,0,0))
-
-                # update the player's frame based on direction
-                if player.attack_state or player.spell_state:
-                    player.target_pos = (None, None)
-                    
-                set_direction(player)
-                
-                # check if a collision exists between the player and the map, if the player isn't attacking
-                if not player.attack_state:
-                    check_collision(player, layers, monster_sprite_list)
-                set_frame(player)
-
-                # if the player attack, see if he hit anything
-                if player.give_damage_state:
-                    check_attack(player, monster_sprite_list)
-
-                # change the frame for all range attacks
-                for range_attack in range_attack_sprite_list.sprites():
-                    set_frame(range_attack)
-                    check_collision(range_attack, layers, active_sprite_list)
-                    if not range_attack.collide:
-                        move_object(range_attack, range_attack.direction)
-
-                # if the player is casting a spell
-                if player.spell_state:
-                    fire_spell.cast_attack(range_attack_sprite_list, player)
-
-                for sprite in monster_sprite_list.sprites():
-
-                    if player.target_pos != (None, None):
-                        # adjust monster position based on player movement
-                        adjust_for_player_movement(sprite, player)
-                        
-                    sprite.set_find_player_state(player)
-                    sprite.set_target_pos(player)
-                    set_direction(sprite)
-                    check_collision(sprite, layers, active_sprite_list)
-                    set_frame(sprite)
-                    if sprite.give_damage_state:
-                        check_attack(sprite, active_sprite_list)
-
-                    if sprite.target_pos != (None, None) :
-                        move_object(sprite, sprite.direction)
-
-                # draw the map
-                for layer in layers.values():
-                    layer[0].update(player)
-                    layer[0].draw(SCREEN)
-
-                # redraw the screen and wait for a clock tick
-                active_sprite_list.draw(SCREEN)
-                monster_sprite_list.draw(SCREEN)
-                item_sprite_list.draw(SCREEN)
-                range_attack_sprite_list.draw(SCREEN)
-                SCREEN.blit(scroll_paper, (0,0))
-                SCREEN.blit(health_state, health_state_rect)
-                SCREEN.blit(health_title, health_title_rect)
-                SCREEN.blit(orc_face, (scroll_paper.get_width()/4,scroll_paper.get_height()/3))
+                            inputs.append((MOVE, camera.screen_to_world(mouse_pos)))
+
+                # finish loading the monsters and the sound effects
+                profiler.mark("loading")
+                loader.pump()
+                if world.flow_field == None and loader.ready('monsters'):
+                    world.spawn_monsters()
+
+                # run the ticks due since the last frame, a slow frame is made up
+                # by drawing less often, the game only slows down past MAX_FRAME_SKIP
+                now = time.perf_counter()
+                lag += now - last_time
+                last_time = now
+                ticks = 0
+                while lag >= tick_time and ticks < MAX_FRAME_SKIP:
+
+                    # a replay plays its own inputs, and ends the game after its last tick
+                    tick_inputs = inputs
+                    if replay != None:
+                        if world.tick >= replay.ticks:
+                            quit_game(recorder)
+                        tick_inputs = replay.inputs(world.tick)
+                    if recorder != None:
+                        recorder.record(tick_inputs)
+
+                    camera.follow(player)
+                    world.snapshot(camera)
+                    world.step(tick_inputs)
+                    audio.play_events(world.sounds)
+                    del inputs[:]
+                    lag -= tick_time
+                    ticks += 1
+                if lag >= tick_time:
+                    lag %= tick_time
+
+                # keep the player in the middle of the screen, drawn between the last two ticks
+                profiler.mark("streaming")
+                alpha = lag / tick_time
+                camera.follow(player)
+                camera.rect.move_ip(world.offset(player, alpha))
+                streamer.update(player.pos_x, player.pos_y)
+
+                # everything drawn over the world this frame
+                profiler.mark("hud")
+                overlay = [hud.draw(player)]
 
                 # display the name, health, and level of the monster
-                for sprite in monster_sprite_list:
-                    if sprite.rect.collidepoint(mouse_pos):
-                        name = fontObj_small.render(str(sprite.name), True, RED)
-                        health = fontObj_small.render(str(sprite.health), True, RED)
-                        level = fontObj_small.render(str(sprite.level), True, RED)
-                        name_rect, health_rect, level_rect =  name.get_rect(), health.get_rect(), level.get_rect()
-                        name_rect.center = (sprite.rect.center[0], sprite.rect.y - name_rect.height)
-                        health_rect.center = (name_rect.x, name_rect.y - health_rect.height)
-                        level_rect.x, level_rect.y = (sprite.rect.center[0], health_rect.y)
-                        SCREEN.blit(name, name_rect)
-                        SCREEN.blit(health, health_rect)
-                        SCREEN.blit(level, level_rect)
+                mouse_rect = pygame.Rect(camera.screen_to_world(mouse_pos), (1, 1))
+                for sprite in world.monster_hash.query_rect(mouse_rect):
+                    if sprite in world.monster_sprite_list:
+                        overlay.append(hud.tooltip(sprite, camera.apply(sprite.rect).move(world.offset(sprite, alpha))))
                         break
-                
-                FPSCLOCK.tick(FPS)
-                pygame.display.update()
-
-if __name__ == '__main__':
-        main()        
 
+                # the profiler shows the frames timed before this one
+                if profiler.timing:
+                    profiler.mark("overlay")
+                    panel = profiler.render(fontObj_small)
+                    if panel != None:
+                        overlay.append((panel, (SCREENWIDTH - panel.get_width(), 0)))
 
+                # redraw what changed and wait for a clock tick
+                rects = renderer.draw(SCREEN, world, camera, overlay, alpha)
 
+                profiler.mark("wait")
+                FPSCLOCK.tick(FPS)
+                profiler.mark("display")
+                pygame.display.update(rects)
+                if profiler.timing:
+                    profiler.end_frame(world.counts(renderer.chunks, renderer.tiles))
 
-                                
-
-        
+if __name__ == '__main__':
+        parser = argparse.ArgumentParser(description='2D RPG game developed using pygame')
+        parser.add_argument('--headless', action='store_true',
+                            help='run the simulation without a display, as fast as possible')
+        parser.add_argument('--ticks', type=int, default=1000, help='ticks to simulate when headless')
+        parser.add_argument('--map', default='game_map.json', help='map file to load')
+        parser.add_argument('--record', help='file the inputs of every tick are recorded to')
+        parser.add_argument('--replay', help='recording to play back, headless it runs as fast as possible')
+        parser.add_argument('--seed', type=int, help='seed of the random module, random by default')
+        args = parser.parse_args()
+
+        if args.headless and args.replay:
+                run_replay(args.replay)
+        elif args.headless:
+                run_headless(args.map, args.ticks)
+        else:
+                main(args.map, args.record, args.replay, args.seed)
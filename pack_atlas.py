@@ -0,0 +1,106 @@
+import pygame, json, os, argparse
+from game import ANIMATION_FILE, ATLAS_FILE, frame_index
+
+ATLAS_WIDTH = 2048 # widest the packed atlas image can be
+PADDING = 1 # empty pixels kept between frames
+
+def load_frames(anim):
+    ''' returns the frames of an animation from its folder or sprite sheet '''
+
+    frames = []
+
+    # the frames are cut out of a sprite sheet
+    if "sheet" in anim:
+        sheet = pygame.image.load(anim["sheet"])
+        width, height = anim["frame_width"], anim["frame_height"]
+        for row in range(anim["first_row"], anim["first_row"] + anim["rows"]):
+            for col in range(anim["first_col"], anim["first_col"] + anim["cols"]):
+                frames.append(sheet.subsurface((col * width, row * height, width, height)))
+
+    # each frame is its own file in a folder
+    else:
+        file_lst = [file for file in os.listdir(anim["directory"]) if anim["prefix"] in file]
+        file_lst.sort(key=frame_index)
+        for file in file_lst:
+            frames.append(pygame.image.load(os.path.join(anim["directory"], file)))
+
+    return frames
+
+def pack_frames(frames):
+    ''' places the frames on shelves, tallest first, and returns the
+        top-left of each frame and the height of the atlas '''
+
+    positions = [None] * len(frames)
+    order = sorted(range(len(frames)), key=lambda index: -frames[index].get_height())
+
+    shelf_x, shelf_y, shelf_height = 0, 0, 0
+    for index in order:
+        width, height = frames[index].get_size()
+
+        # start a new shelf when the frame doesn't fit on this one
+        if shelf_x + width > ATLAS_WIDTH:
+            shelf_x, shelf_y, shelf_height = 0, shelf_y + shelf_height + PADDING, 0
+
+        positions[index] = (shelf_x, shelf_y)
+        shelf_x += width + PADDING
+        shelf_height = max(shelf_height, height)
+
+    return positions, shelf_y + shelf_height
+
+def pack_atlas(spec_file, manifest_file, image_file):
+    ''' packs every animation of the spec into one image and writes
+        the manifest of its frame rects '''
+
+    spec = json.loads(open(spec_file).read())["animations"]
+
+    # gather the frames of every animation which can be found
+    all_frames = []
+    owners = []
+    for name, anim in spec.items():
+        try:
+            frames = load_frames(anim)
+        except (OSError, pygame.error) as error:
+            print("skipping %s: %s" % (name, error))
+            continue
+        if len(frames) < anim["rows"] * anim["cols"]:
+            print("skipping %s: found %d of %d frames" % (name, len(frames), anim["rows"] * anim["cols"]))
+            continue
+        for frame in frames[:anim["rows"] * anim["cols"]]:
+            all_frames.append(frame)
+            owners.append(name)
+
+    positions, height = pack_frames(all_frames)
+
+    # blit every frame onto a black atlas, black is the colorkey
+    atlas = pygame.Surface((ATLAS_WIDTH, max(height, 1)), 0, 32)
+    atlas.fill((0, 0, 0))
+    manifest = {"image": image_file, "animations": {}}
+    for frame, owner, position in zip(all_frames, owners, positions):
+        atlas.blit(frame, position)
+        if owner not in manifest["animations"]:
+            anim = dict((key, value) for key, value in spec[owner].items()
+                        if key in ["rows", "cols", "colorkey", "directions"])
+            anim["frames"] = []
+            manifest["animations"][owner] = anim
+        manifest["animations"][owner]["frames"].append([position[0], position[1],
+                                                        frame.get_width(), frame.get_height()])
+
+    pygame.image.save(atlas, image_file)
+    with open(manifest_file, 'w') as file:
+        json.dump(manifest, file)
+
+    print("packed %d frames of %d animations into %s (%dx%d)" %
+          (len(all_frames), len(manifest["animations"]), image_file, ATLAS_WIDTH, height))
+
+def main():
+
+    parser = argparse.ArgumentParser(description='packs the animation frames into one atlas image')
+    parser.add_argument('--spec', default=ANIMATION_FILE, help='layout of every animation')
+    parser.add_argument('--manifest', default=ATLAS_FILE, help='manifest file to write')
+    parser.add_argument('--image', default='atlas.png', help='atlas image to write')
+    args = parser.parse_args()
+
+    pack_atlas(args.spec, args.manifest, args.image)
+
+if __name__ == '__main__':
+        main()